@@ -1,7 +1,7 @@
 import os
 
-import unify
 import wget
+from marking_assistant.optimize_agent.cache_store import merge_cache_files
 
 if os.path.exists(".cache.json"):
     os.remove(".cache.json")
@@ -9,6 +9,10 @@ if os.path.exists(".latest_cache.json"):
     os.remove(".latest_cache.json")
 if os.path.exists(".prev_cache.json"):
     os.remove(".prev_cache.json")
+# sidecar stores which earlier versions of the merge left behind
+for fname in (".latest_cache.db", ".prev_cache.db"):
+    if os.path.exists(fname):
+        os.remove(fname)
 
 wget.download(
     "https://raw.githubusercontent.com/unifyai/demos/1cd42e27931037b69ea87821588dc097e1af68be/marking_assistant/.cache.json",
@@ -20,13 +24,9 @@ wget.download(
 )
 os.rename(".cache.json", ".prev_cache.json")
 
-unify.cache_file_intersection(
+merge_cache_files(
+    "difference",
     ".latest_cache.json",
     ".prev_cache.json",
-    ".intersection_cache.json",
-)
-unify.subtract_cache_files(
-    ".latest_cache.json",
-    ".intersection_cache.json",
     ".cache.json",
 )
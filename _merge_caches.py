@@ -1,6 +1,7 @@
-import unify
+from marking_assistant.optimize_agent.cache_store import merge_cache_files
 
-unify.cache_file_union(
+merge_cache_files(
+    "union",
     ".cache.json",
     "marking_assistant/.cache.json",
     "marking_assistant/.merged_cache.json",
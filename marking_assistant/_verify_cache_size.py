@@ -1,7 +1,9 @@
-import json
 import os
 
+from optimize_agent.cache_store import open_store
+
 this_dir = os.path.dirname(os.path.abspath(__file__))
-with open(os.path.join(this_dir, ".cache.json")) as file:
-    data = json.load(file)
-print("length of .cache.json:", len(data))
+# the store is re-imported if .cache.json is newer, so a stale store is never counted
+store = open_store(os.path.join(this_dir, ".cache.json"))
+print("length of .cache.json:", len(store))
+store.close()
@@ -0,0 +1,426 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def hash_key(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class _JsonReader:
+    """Reads the raw text of successive json values from a file, one chunk at a time."""
+
+    def __init__(self, file, chunk_size):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+
+    def _fill(self):
+        more = self._file.read(self._chunk_size)
+        self._buffer = self._buffer[self._pos :] + more
+        self._pos = 0
+        return bool(more)
+
+    def peek(self):
+        """The next non-whitespace character, or None at the end of the file."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return None
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in json cache file, found {found!r}")
+        self._pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                _, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # a value (such as a number) which is not followed by a delimiter
+                # may continue in the next chunk
+                if end < len(self._buffer) and self._buffer[end] in " \t\r\n,:]}":
+                    break
+            except json.JSONDecodeError:
+                pass
+            if not self._fill():
+                _, end = self._decoder.raw_decode(self._buffer, self._pos)
+                break
+        text = self._buffer[self._pos : end]
+        self._pos = end
+        return text
+
+
+def iter_json(fpath, chunk_size=1024**2):
+    """
+    Yields the (key, raw json value) entries of a `.json` cache file one at a time,
+    reading the file in chunks, so only the current entry is ever held in memory.
+    """
+    with open(fpath) as file:
+        reader = _JsonReader(file, chunk_size)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            key = json.loads(reader.value())
+            reader.expect(":")
+            yield key, reader.value()
+            if reader.peek() != ",":
+                reader.expect("}")
+                return
+            reader.expect(",")
+
+
+def iter_entries(fpath):
+    """The (key, raw json value) entries of a `.json` cache file or `.db` store."""
+    if fpath.endswith(".json"):
+        yield from iter_json(fpath)
+        return
+    store = CacheStore(fpath)
+    try:
+        for _, key, value in store.items():
+            yield key, value
+    finally:
+        store.close()
+
+
+class CacheStore:
+    """
+    Content-addressed on-disk store for LLM responses, using the same keys and values
+    as `.cache.json`. The unify cache key already serializes the model, messages and
+    response format of each request, so entries are addressed by a hash of that key.
+    Each entry also stores the `request_digest` of its key in an indexed column, so
+    that agent calls can be looked up without rebuilding the whole key. Lookups go
+    through an index, so nothing is loaded until it is asked for.
+    """
+
+    def __init__(self, path=".cache.db"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(hash TEXT PRIMARY KEY, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "request BLOB)",
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)",
+            )
+            columns = [
+                row[1] for row in self._conn.execute("PRAGMA table_info(entries)")
+            ]
+            if "request" not in columns:
+                # stores written before the request column was added
+                self._conn.execute("ALTER TABLE entries ADD COLUMN request BLOB")
+                self._conn.executemany(
+                    "UPDATE entries SET request = ? WHERE hash = ?",
+                    [
+                        (key_digest(key), hash)
+                        for hash, key in self._conn.execute(
+                            "SELECT hash, key FROM entries",
+                        ).fetchall()
+                    ],
+                )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_request ON entries (request)",
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __contains__(self, key):
+        return self.get_raw(key) is not None
+
+    def get_raw(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM entries WHERE hash = ?",
+                (hash_key(key),),
+            ).fetchone()
+        return row[0] if row else None
+
+    def get(self, key, default=None):
+        value = self.get_raw(key)
+        return default if value is None else json.loads(value)
+
+    def get_raw_request(self, digest):
+        """The raw value of the entry whose key holds the request `digest`, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM entries WHERE request = ? LIMIT 1",
+                (digest,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, items):
+        self.put_raw_many((k, json.dumps(v)) for k, v in items)
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def keys(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM entries").fetchall()
+        return [row[0] for row in rows]
+
+    def items(self):
+        # ordered by hash, so that exports are deterministic
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT hash, key, value FROM entries ORDER BY hash")
+        yield from cursor
+
+    def get_meta(self, name):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE name = ?",
+                (name,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, name, value):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                (name, value),
+            )
+
+    def import_json(self, fpath):
+        self.put_raw_many(iter_json(fpath))
+
+    def put_raw_many(self, items):
+        """Stores (key, value) pairs whose values are already serialized as json."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                ((hash_key(k), k, v, key_digest(k)) for k, v in items),
+            )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entries")
+
+    def export_json(self, fpath):
+        write_json(((key, value) for _, key, value in self.items()), fpath)
+
+    def close(self):
+        self._conn.close()
+
+
+def write_json(rows, fpath):
+    # written entry by entry, without building the whole dict in memory
+    with open(fpath, "w+") as file:
+        file.write("{")
+        for i, (key, value) in enumerate(rows):
+            file.write(("," if i else "") + f"\n{json.dumps(key)}: {value}")
+        file.write("\n}")
+
+
+def open_store(fpath):
+    """
+    Opens a `.db` store directly, or the `.db` store next to a `.json` cache file,
+    importing the `.json` file first if the store is missing or older than it. If
+    only the store exists, it is opened as is.
+    """
+    if not fpath.endswith(".json"):
+        return CacheStore(fpath)
+    db_path = fpath[: -len(".json")] + ".db"
+    stale = os.path.exists(fpath) and (
+        not os.path.exists(db_path)
+        or os.path.getmtime(db_path) < os.path.getmtime(fpath)
+    )
+    store = CacheStore(db_path)
+    if stale:
+        store.clear()
+        store.import_json(fpath)
+    return store
+
+
+def _request(key):
+    # cache keys are the function name followed by the request kwargs as json
+    start = key.find("{")
+    if start < 0:
+        return None
+    try:
+        request = json.loads(key[start:])
+    except json.JSONDecodeError:
+        return None
+    return request if isinstance(request, dict) else None
+
+
+def request_digest(model, messages, response_format=None):
+    """
+    Digest of the parts of a request which determine its response: the endpoint,
+    the content of each message and the response format, as a json schema either
+    parsed or still serialized as a string (as the unify cache key holds it).
+    """
+    if isinstance(response_format, str):
+        try:
+            response_format = json.loads(response_format)
+        except json.JSONDecodeError:
+            pass
+    payload = json.dumps(
+        [model, [m.get("content") for m in messages], response_format],
+        sort_keys=True,
+    )
+    return _digest(payload)
+
+
+def key_digest(key):
+    """The `request_digest` of the request serialized into a cache key, if any."""
+    request = _request(key)
+    if request is None or "messages" not in request:
+        return None
+    return request_digest(
+        request.get("model"),
+        request["messages"],
+        request.get("response_format"),
+    )
+
+
+class RequestIndex:
+    """
+    Exact lookup of agent calls in a `CacheStore`, by the request serialized into
+    each cache key. The keys also hold client defaults which are not exposed on the
+    agent, so the lookup matches the endpoint, messages and response format of the
+    request exactly rather than rebuilding the whole key. The store indexes the
+    digest of each key as it is imported, so each call is a single query.
+    """
+
+    def __init__(self, store):
+        self._store = store
+
+    @staticmethod
+    def _agent_digest(agent, **kwargs):
+        response_format = agent.response_format
+        if hasattr(response_format, "model_json_schema"):
+            response_format = response_format.model_json_schema()
+        messages = [{"role": "system", "content": agent.system_message}]
+        return request_digest(
+            agent.endpoint,
+            messages + (kwargs.get("messages") or list()),
+            response_format,
+        )
+
+    def contains(self, agent, **kwargs):
+        digest = self._agent_digest(agent, **kwargs)
+        return self._store.get_raw_request(digest) is not None
+
+    def response(self, agent, **kwargs):
+        """The cached response text of the call, or None if it is not cached."""
+        value = self._store.get_raw_request(self._agent_digest(agent, **kwargs))
+        if value is None:
+            return None
+        return response_content(json.loads(value))
+
+
+def response_content(value):
+    """
+    The message content of a cached chat completion. unify stores each completion
+    json-encoded as a string, either as the value itself or, in newer caches, under
+    `"value"` next to its `"res_types"`.
+    """
+    if isinstance(value, dict) and "value" in value:
+        value = value["value"]
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value["choices"][0]["message"]["content"]
+
+
+def _digest(key):
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+def set_operation(operation, first, second, stats):
+    """
+    Streams the union, intersection or difference of two caches, given as callables
+    which return a fresh iterator over their (key, raw json value) entries. Each
+    input is read at most twice, and only a 16 byte digest per key of one input is
+    held in memory. Entries from `first` take precedence. `stats` is updated with
+    the number of entries added to and dropped from `first`, and the number of
+    bytes in the result.
+    """
+    if operation not in ("union", "intersection", "difference"):
+        raise ValueError(f"Invalid set operation: {operation}")
+
+    def _emit(key, value, added):
+        stats["added"] += int(added)
+        stats["bytes"] += len(key.encode()) + len(value.encode())
+        return key, value
+
+    if operation == "union":
+        first_keys = set()
+        for key, value in first():
+            first_keys.add(_digest(key))
+            yield _emit(key, value, False)
+        for key, value in second():
+            if _digest(key) not in first_keys:
+                yield _emit(key, value, True)
+        return
+    second_keys = {_digest(key) for key, _ in second()}
+    for key, value in first():
+        if (_digest(key) in second_keys) == (operation == "intersection"):
+            yield _emit(key, value, False)
+        else:
+            stats["dropped"] += 1
+
+
+def merge_cache_files(operation, first, second, target):
+    """
+    Writes the set operation of two `.json` cache files or `.db` stores straight
+    into `target`, without any intermediate files.
+    """
+    stats = dict(added=0, dropped=0, bytes=0)
+    rows = set_operation(
+        operation,
+        lambda: iter_entries(first),
+        lambda: iter_entries(second),
+        stats,
+    )
+    if target.endswith(".json"):
+        write_json(rows, target)
+    else:
+        target_store = CacheStore(target)
+        target_store.put_raw_many(rows)
+        target_store.close()
+    print(
+        f"{operation} of {first} and {second} -> {target}: "
+        f"{stats['added']} entries added, {stats['dropped']} dropped, "
+        f"{stats['bytes']} bytes",
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["import", "export", "count", "union", "intersection", "difference"],
+    )
+    parser.add_argument("--db", default=".cache.db", type=str)
+    parser.add_argument("--json", default=".cache.json", type=str)
+    parser.add_argument("--first", type=str)
+    parser.add_argument("--second", type=str)
+    parser.add_argument("--target", type=str)
+    args = parser.parse_args()
+
+    if args.command in ("union", "intersection", "difference"):
+        merge_cache_files(args.command, args.first, args.second, args.target)
+    else:
+        store = CacheStore(args.db)
+        if args.command == "import":
+            store.import_json(args.json)
+        elif args.command == "export":
+            store.export_json(args.json)
+        print(f"length of {args.db}:", len(store))
+        store.close()
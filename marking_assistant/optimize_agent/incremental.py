@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import threading
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+fingerprints_dir = os.path.join(this_dir, ".fingerprints")
+
+
+def fingerprint(agent, **kwargs):
+    """
+    Hashes everything which determines the response of an agent call: the endpoint,
+    the fully rendered system message, the response format and any extra messages.
+    """
+    response_format = agent.response_format
+    if hasattr(response_format, "model_json_schema"):
+        response_format = response_format.model_json_schema()
+    payload = json.dumps(
+        {
+            "endpoint": agent.endpoint,
+            "system_message": agent.system_message,
+            "response_format": response_format,
+            "messages": kwargs.get("messages"),
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def placeholder_response(response_format):
+    def _value(annotation):
+        if hasattr(annotation, "model_fields"):
+            return {k: _value(f.annotation) for k, f in annotation.model_fields.items()}
+        return {bool: False, int: 0, float: 0.0}.get(annotation, "")
+
+    return json.dumps(_value(response_format))
+
+
+class IncrementalEvaluator:
+    """
+    Tracks each (example_id, sub-question, mark) unit of work by fingerprint, and only
+    re-issues the units whose fingerprint changed since the previous experiment(s).
+    All other responses are copied forward from the stored results.
+
+    With `dry_run=True` nothing is issued. Changed units found in the `cache` (a
+    `RequestIndex`) return the cached response, as the read-only cache would. The
+    system messages of the other changed units, which would need live calls, are
+    collected in `pending`, and the previous (or a placeholder) response is returned
+    in their place.
+    """
+
+    def __init__(
+        self,
+        experiment,
+        previous=None,
+        telemetry=None,
+        dry_run=False,
+        cache=None,
+    ):
+        self._experiment = experiment
+        self._telemetry = telemetry
+        self._dry_run = dry_run
+        self._cache = cache
+        self.pending = list()
+        self._lock = threading.Lock()
+        self._previous = dict()
+        for name in ([previous] if previous else []) + [experiment]:
+            self._previous.update(self._load(name))
+        self._current = dict()
+        self.reused = 0
+        self.issued = 0
+
+    @staticmethod
+    def _path(experiment):
+        return os.path.join(fingerprints_dir, f"{experiment}.json")
+
+    def _load(self, experiment):
+        if not os.path.exists(self._path(experiment)):
+            return dict()
+        with open(self._path(experiment)) as file:
+            return json.load(file)
+
+    def generate(self, unit, agent, family=None, **kwargs):
+        fp = fingerprint(agent, **kwargs)
+        prev = self._previous.get(unit)
+        if prev is not None and prev["fingerprint"] == fp:
+            response = prev["response"]
+            reused = True
+            if self._telemetry:
+                self._telemetry.record_copied(family)
+        elif self._dry_run:
+            cached = self._cache.response(agent, **kwargs) if self._cache else None
+            with self._lock:
+                self.issued += 1
+                if cached is None:
+                    self.pending.append(agent.system_message)
+            if cached is not None:
+                return cached
+            if prev is not None:
+                return prev["response"]
+            return placeholder_response(agent.response_format)
+        elif self._telemetry:
+            response = self._telemetry.generate(family, agent, **kwargs)
+            reused = False
+        else:
+            response = agent.generate(**kwargs)
+            reused = False
+        with self._lock:
+            self._current[unit] = {"fingerprint": fp, "response": response}
+            if reused:
+                self.reused += 1
+            else:
+                self.issued += 1
+        return response
+
+    def save(self):
+        os.makedirs(fingerprints_dir, exist_ok=True)
+        with self._lock:
+            with open(self._path(self._experiment), "w+") as file:
+                file.write(json.dumps(self._current, indent=4))
+        print(
+            f"{self._experiment}: re-issued {self.issued} units, "
+            f"copied forward {self.reused} units",
+        )
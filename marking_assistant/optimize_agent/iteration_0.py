@@ -1,8 +1,7 @@
-import os
 import textwrap
 
 import unify
-import wget
+from shared import fetch_cache, load_dataset
 
 unify.activate("MarkingAssistant")
 unify.set_context("Evals")
@@ -11,16 +10,10 @@ unify.set_context("Evals")
 agent = unify.Unify("o3-mini@openai", traced=True, cache="read-only")
 
 
-if os.path.exists(".cache.json"):
-    os.remove(".cache.json")
-wget.download(
-    "https://raw.githubusercontent.com/"
-    "unifyai/demos/refs/heads/main/"
-    "marking_assistant/.cache.json",
-)
+fetch_cache()
 
 
-test_set_10 = unify.download_dataset("TestSet10")
+test_set_10 = load_dataset("TestSet10")
 
 
 def pretty_print_dict(d, indent=0):
@@ -1,29 +1,24 @@
 import json
-import os
 import re
 import textwrap
 
 import unify
-import wget
-from pydantic import BaseModel
+from cache_store import RequestIndex, open_store
+from incremental import IncrementalEvaluator
+from near_miss import NearMissIndex
+from pydantic import BaseModel, ValidationError, create_model
+from shared import fetch_cache, load_dataset
+from telemetry import CacheTelemetry
+from templates import PrefixRenderer, PrefixStats, PromptTemplate
 
-unify.activate("MarkingAssistant")
-unify.set_context("Evals")
+# score all marks of a sub-question with a single structured-output call
+batch_marks = False
 
+# order prompt segments from most-static to most-dynamic, for provider prefix caching
+static_first_layout = False
 
-agent = unify.Unify("o3-mini@openai", traced=True, cache="read-only")
-
-
-if os.path.exists(".cache.json"):
-    os.remove(".cache.json")
-wget.download(
-    "https://raw.githubusercontent.com/"
-    "unifyai/demos/refs/heads/main/"
-    "marking_assistant/.cache.json",
-)
-
-
-test_set_10 = unify.download_dataset("TestSet10")
+# only estimate how many live (uncached) calls this iteration needs, without running it
+estimate_only = False
 
 
 def pretty_print_dict(d, indent=0):
@@ -127,7 +122,8 @@ When students are explaining something in their answer, then their explanation m
 )
 
 
-subq_system_message = """
+subq_system_message = PromptTemplate(
+    """
 Your task is to award a suitable number of marks for a student's answer to question {subq}, from 0 up to a maximum of {available_marks} marks.
 
 The general marking guidelines (relevant for all questions) are as follows:
@@ -160,13 +156,12 @@ The markscheme for this specific question is:
 {mark_observations}
 
 {output_response_explanation}
-""".replace(
-    "{general_guidelines}",
-    general_guidelines,
-)
+""",
+).partial(general_guidelines=general_guidelines)
 
 
-mark_system_message = """
+mark_system_message = PromptTemplate(
+    """
 Your task is to determine whether mark {mark} should be awarded for the following student's answer to question {subq}, based on the provided markscheme.
 
 The general marking guidelines (relevant for all questions) are as follows:
@@ -196,10 +191,153 @@ The markscheme for this specific question, with the mark in question {mark} expr
 
 {mark_types_explanation}
 You should populate the `thoughts` field with your thoughts on the whether the specific mark {mark} identified within the markscheme should be awarded for the student's answer. This {mark} mark might be irrelevant given the student's approach or answer, in which case just respond `False` for the `should_award` field, and explain this in the `thoughts` field. Please think carefully about your decision for awarding this {mark} mark, considering the general guidelines.
-""".replace(
-    "{general_guidelines}",
-    general_guidelines,
-)
+""",
+).partial(general_guidelines=general_guidelines)
+
+
+batched_mark_system_message = PromptTemplate(
+    """
+Your task is to determine whether each of the marks {marks} should be awarded for the following student's answer to question {subq}, based on the provided markscheme.
+
+The general marking guidelines (relevant for all questions) are as follows:
+
+{general_guidelines}
+
+
+The *overall* question is:
+
+{question}
+
+{prior_context}
+
+The specific question you need to mark is:
+
+{subquestion}
+
+
+Their answer to this specific question is:
+
+{answer}
+
+
+The markscheme for this specific question, with each of the marks in question expressed in bold, is as follows:
+
+{markscheme}
+
+{mark_types_explanation}
+For each of the marks {marks}, you should populate the `thoughts` field with your thoughts on whether that specific mark identified within the markscheme should be awarded for the student's answer. Each mark might be irrelevant given the student's approach or answer, in which case just respond `False` for its `should_award` field, and explain this in its `thoughts` field. Please think carefully about your decision for awarding each mark *independently*, considering the general guidelines.
+""",
+).partial(general_guidelines=general_guidelines)
+
+
+if static_first_layout:
+    subq_system_message = PromptTemplate(
+        """
+You will be asked to award a suitable number of marks for a student's answer to a question.
+
+The general marking guidelines (relevant for all questions) are as follows:
+
+{general_guidelines}
+
+{output_response_explanation}
+
+The *overall* question is:
+
+{question}
+
+{prior_context}
+
+The specific question you need to mark is:
+
+{subquestion}
+
+
+Their answer to this specific question is:
+
+{answer}
+
+
+The markscheme for this specific question is:
+
+{markscheme}
+
+{mark_types_explanation}
+
+{mark_observations}
+
+Your task is to award a suitable number of marks for the student's answer to question {subq}, from 0 up to a maximum of {available_marks} marks.
+""",
+    ).partial(general_guidelines=general_guidelines)
+
+    mark_system_message = PromptTemplate(
+        """
+You will be asked to determine whether a specific mark should be awarded for a student's answer to a question, based on the provided markscheme.
+
+The general marking guidelines (relevant for all questions) are as follows:
+
+{general_guidelines}
+
+You should populate the `thoughts` field with your thoughts on whether the specific mark identified within the markscheme should be awarded for the student's answer. This mark might be irrelevant given the student's approach or answer, in which case just respond `False` for the `should_award` field, and explain this in the `thoughts` field. Please think carefully about your decision for awarding this mark, considering the general guidelines.
+
+The *overall* question is:
+
+{question}
+
+{prior_context}
+
+The specific question you need to mark is:
+
+{subquestion}
+
+
+Their answer to this specific question is:
+
+{answer}
+
+
+The markscheme for this specific question, with the mark in question expressed in bold and with a prepending `(to consider!)`, is as follows:
+
+{markscheme}
+
+{mark_types_explanation}
+Your task is to determine whether mark {mark} should be awarded for the student's answer to question {subq}.
+""",
+    ).partial(general_guidelines=general_guidelines)
+
+    batched_mark_system_message = PromptTemplate(
+        """
+You will be asked to determine whether each of several marks should be awarded for a student's answer to a question, based on the provided markscheme.
+
+The general marking guidelines (relevant for all questions) are as follows:
+
+{general_guidelines}
+
+For each mark, you should populate the `thoughts` field with your thoughts on whether that specific mark identified within the markscheme should be awarded for the student's answer. Each mark might be irrelevant given the student's approach or answer, in which case just respond `False` for its `should_award` field, and explain this in its `thoughts` field. Please think carefully about your decision for awarding each mark *independently*, considering the general guidelines.
+
+The *overall* question is:
+
+{question}
+
+{prior_context}
+
+The specific question you need to mark is:
+
+{subquestion}
+
+
+Their answer to this specific question is:
+
+{answer}
+
+
+The markscheme for this specific question, with each of the marks in question expressed in bold, is as follows:
+
+{markscheme}
+
+{mark_types_explanation}
+Your task is to determine whether each of the marks {marks} should be awarded for the student's answer to question {subq}.
+""",
+    ).partial(general_guidelines=general_guidelines)
 
 
 prior_context_exp = """
@@ -228,6 +366,14 @@ class ThoughtsAndAwardDecision(BaseModel):
     should_award: bool
 
 
+@unify.traced(name="create_batched_marks_format_{mark_keys}")
+def create_batched_marks_format(mark_keys):
+    return create_model(
+        "BatchedMarks",
+        **{k: (ThoughtsAndAwardDecision, ...) for k in mark_keys},
+    )
+
+
 @unify.traced(name="parse_marks_from_markscheme{subquestion}")
 def parse_marks_from_markscheme(subquestion: str, markscheme: str):
     extracted_marks = re.findall(r"(?:SC|M|A|B)\d+", markscheme)
@@ -287,6 +433,165 @@ def extract_mark_type_explanation(
     return full_exp.replace("{mark_types_explanation}", "")
 
 
+def render_system_messages(
+    subq_system_message,
+    mark_system_message,
+    question_num,
+    question,
+    sub_questions,
+    markscheme,
+    answer,
+    available_marks,
+):
+    """
+    The parsed markscheme of each sub-question, and its sub-question, mark and
+    batched mark system messages, with only the per-mark slots (and the mark
+    observations) left to render.
+    """
+    with_subqs = len(markscheme) > 1
+    subq_keys = list(sub_questions.keys())
+    prior_contexts = PrefixRenderer(
+        lambda j: pretty_print_dict(
+            {
+                subq_keys[j]: {
+                    "sub-question": sub_questions[subq_keys[j]],
+                    "markscheme": markscheme[subq_keys[j]],
+                    "answer": answer[subq_keys[j]],
+                },
+            },
+            indent=4,
+        ),
+    )
+    parsed_markschemes = list()
+    subq_sys_msgs = list()
+    mark_sys_msgs = list()
+    batched_mark_sys_msgs = list()
+    for i, k in enumerate(markscheme.keys()):
+        parsed_markscheme = parse_marks_from_markscheme(
+            f"_{k}" if k != "_" else "",
+            markscheme[k],
+        )
+        parsed_markschemes.append(parsed_markscheme)
+        this_markscheme = markscheme[k]
+        for j, (mark, chunk) in enumerate(parsed_markscheme):
+            this_markscheme = this_markscheme.replace(
+                chunk,
+                chunk.replace(
+                    mark,
+                    f"{mark}({len([m for m, _ in parsed_markscheme[0:j] if m == mark])})",
+                ),
+            )
+        # the prompts the cached responses were generated from cut the prior
+        # context at the index of the sub-question's last mark, not of the
+        # sub-question itself, so keep doing so to keep hitting the cache
+        n = len(parsed_markscheme) - 1 if parsed_markscheme else i
+        prior_context = (
+            prior_context_exp + prior_contexts.render(min(n, len(subq_keys)))
+            if with_subqs and n > 0
+            else ""
+        )
+        subq_sys_msgs.append(
+            subq_system_message.partial(
+                subq=k.replace("_", str(question_num)),
+                question=textwrap.indent(question, " " * 4),
+                subquestion=textwrap.indent(sub_questions[k], " " * 4),
+                markscheme=textwrap.indent(this_markscheme, " " * 4),
+                mark_types_explanation=textwrap.indent(
+                    extract_mark_type_explanation(
+                        f"_{k}" if k != "_" else "",
+                        markscheme[k],
+                    ),
+                    " " * 4,
+                ),
+                answer=textwrap.indent(answer[k], " " * 4),
+                available_marks=str(available_marks[k.replace("_", "total")]),
+                output_response_explanation=output_response_explanation,
+                prior_context=prior_context,
+            ),
+        )
+        mark_sys_msgs.append(
+            mark_system_message.partial(
+                subq=k.replace("_", str(question_num)),
+                question=textwrap.indent(question, " " * 4),
+                subquestion=textwrap.indent(sub_questions[k], " " * 4),
+                answer=textwrap.indent(answer[k], " " * 4),
+                prior_context=prior_context,
+            ),
+        )
+        batched_mark_sys_msgs.append(
+            batched_mark_system_message.partial(
+                subq=k.replace("_", str(question_num)),
+                question=textwrap.indent(question, " " * 4),
+                subquestion=textwrap.indent(sub_questions[k], " " * 4),
+                answer=textwrap.indent(answer[k], " " * 4),
+                prior_context=prior_context,
+            ),
+        )
+    return parsed_markschemes, subq_sys_msgs, mark_sys_msgs, batched_mark_sys_msgs
+
+
+def render_mark_system_messages(mark_sys_msg, markscheme, parsed_markscheme):
+    return [
+        mark_sys_msg.render(
+            mark=k,
+            markscheme=textwrap.indent(
+                markscheme.replace(
+                    v,
+                    v.replace(k, f"**{k}** (to consider!)"),
+                ),
+                " " * 4,
+            ),
+            mark_types_explanation=extract_mark_type_explanation(
+                f"_{k}({i})" if k != "_" else "",
+                markscheme,
+                [k],
+            ),
+        )
+        for i, (k, v) in enumerate(parsed_markscheme)
+    ]
+
+
+@unify.traced(name="call_batched_mark_agent_{subq}")
+def call_batched_mark_agent(
+    example_id,
+    subq,
+    mark_keys,
+    markscheme,
+    parsed_markscheme,
+    batched_mark_sys_msg,
+):
+    batched_agent = agent.copy()
+    response_format = create_batched_marks_format(mark_keys)
+    batched_agent.set_response_format(response_format)
+    labelled_markscheme = markscheme
+    for (k, v), key in zip(parsed_markscheme, mark_keys):
+        labelled_markscheme = labelled_markscheme.replace(
+            v,
+            v.replace(k, f"**{key}**"),
+        )
+    batched_agent.set_system_message(
+        batched_mark_sys_msg.render(
+            marks=", ".join(mark_keys),
+            markscheme=textwrap.indent(labelled_markscheme, " " * 4),
+            mark_types_explanation=extract_mark_type_explanation(
+                f"_{subq}",
+                markscheme,
+            ),
+        ),
+    )
+    prefix_stats.record("batched_mark", batched_agent.system_message)
+    ret = incremental.generate(
+        f"{example_id}/{subq}/batched",
+        batched_agent,
+        family="batched_mark",
+        tags=[subq + "(batched)"],
+    )
+    try:
+        return response_format.model_validate_json(ret).model_dump()
+    except ValidationError:
+        return None
+
+
 @unify.traced(name="call_subq_agent_{subq}")
 def call_subq_agent(
     example_id,
@@ -294,48 +599,56 @@ def call_subq_agent(
     subq_agent,
     markscheme,
     parsed_markscheme,
+    subq_sys_msg,
     mark_sys_msg,
+    batched_mark_sys_msg,
 ):
     mark_agents = [[k, agent.copy()] for k in [itm[0] for itm in parsed_markscheme]]
     [agnt.set_response_format(ThoughtsAndAwardDecision) for _, agnt in mark_agents]
-    for i, (k, v) in enumerate(parsed_markscheme):
-        mark_agents[i][1].set_system_message(
-            mark_sys_msg.replace(
-                "{mark}",
-                k,
-            )
-            .replace(
-                "{markscheme}",
-                textwrap.indent(
-                    markscheme.replace(
-                        v,
-                        v.replace(k, f"**{k}** (to consider!)"),
-                    ),
-                    " " * 4,
-                ),
-            )
-            .replace(
-                "{mark_types_explanation}",
-                extract_mark_type_explanation(
-                    f"_{k}({i})" if k != "_" else "",
-                    markscheme,
-                    [k],
-                ),
-            ),
-        )
     if mark_agents:
         explanation = "An expert marker has already taken a look at the student's answer, and they have made the following observations for each of the candidate marks mentioned in the markscheme. You should pay special attention to these observations."
-        vals = unify.map(
-            lambda i, m, a: json.loads(a.generate(tags=[m + f"({i})"])),
-            [tuple([i] + item) for i, item in enumerate(mark_agents)],
-            name=f"Evals[{example_id}]->SubQAgent[{subq}]->MarkAgent",
-        )
         keys = list()
         for k, _ in mark_agents:
             keys.append(
                 k + f"({len([ky for ky in keys if k in ky])})",
             )
-        mark_obs_dict = dict(zip(keys, vals))
+        mark_obs_dict = None
+        if batch_marks:
+            mark_obs_dict = call_batched_mark_agent(
+                example_id,
+                subq,
+                keys,
+                markscheme,
+                parsed_markscheme,
+                batched_mark_sys_msg,
+            )
+        # fall back to one call per mark if batching is off or failed validation
+        mark_agent_mode = "batched" if mark_obs_dict is not None else "per_mark"
+        if mark_obs_dict is None:
+            # only rendered (and recorded) when the per-mark calls are issued
+            for (_, agnt), system_message in zip(
+                mark_agents,
+                render_mark_system_messages(
+                    mark_sys_msg,
+                    markscheme,
+                    parsed_markscheme,
+                ),
+            ):
+                agnt.set_system_message(system_message)
+                prefix_stats.record("mark", agnt.system_message)
+            vals = unify.map(
+                lambda i, m, a: json.loads(
+                    incremental.generate(
+                        f"{example_id}/{subq}/{m}({i})",
+                        a,
+                        family="mark",
+                        tags=[m + f"({i})"],
+                    ),
+                ),
+                [tuple([i] + item) for i, item in enumerate(mark_agents)],
+                name=f"Evals[{example_id}]->SubQAgent[{subq}]->MarkAgent",
+            )
+            mark_obs_dict = dict(zip(keys, vals))
         mark_observations = (
             explanation
             + "\n\n"
@@ -347,12 +660,15 @@ def call_subq_agent(
     else:
         mark_observations = ""
     subq_agent.set_system_message(
-        subq_agent.system_message.replace(
-            "{mark_observations}",
-            mark_observations,
-        ),
+        subq_sys_msg.render(mark_observations=mark_observations),
+    )
+    prefix_stats.record("subq", subq_agent.system_message)
+    ret = incremental.generate(
+        f"{example_id}/{subq}",
+        subq_agent,
+        family="subq",
+        tags=[subq],
     )
-    ret = subq_agent.generate(tags=[subq])
     if "```" in ret:
         ret = ret.split("```")[-2].lstrip("json")
     ret = json.loads(ret)
@@ -362,6 +678,7 @@ def call_subq_agent(
         **mark_obs_dict,
         "overall_thoughts": ret["reasoning"],
     }
+    ret["mark_agent_mode"] = mark_agent_mode
     return ret
 
 
@@ -378,7 +695,6 @@ def call_agent(
     available_marks,
 ):
     subq_agents = {k: agent.copy() for k in markscheme.keys()}
-    with_subqs = len(markscheme) > 1
     response_formats = {k: MarksAndReasoning for k, v in markscheme.items()}
     [
         agnt.set_response_format(rf)
@@ -387,130 +703,27 @@ def call_agent(
             response_formats.values(),
         )
     ]
-    mark_sys_msgs = list()
-    parsed_markschemes = list()
-    for i, k in enumerate(markscheme.keys()):
-        parsed_markscheme = parse_marks_from_markscheme(
-            f"_{k}" if k != "_" else "",
-            markscheme[k],
-        )
-        parsed_markschemes.append(parsed_markscheme)
-        this_markscheme = markscheme[k]
-        for i, (mark, chunk) in enumerate(parsed_markscheme):
-            this_markscheme = this_markscheme.replace(
-                chunk,
-                chunk.replace(
-                    mark,
-                    f"{mark}({len([m for m, _ in parsed_markscheme[0:i] if m == mark])})",
-                ),
-            )
-        subq_agents[k].set_system_message(
-            subq_system_message.replace(
-                "{subq}",
-                k.replace("_", str(question_num)),
-            )
-            .replace(
-                "{question}",
-                textwrap.indent(question, " " * 4),
-            )
-            .replace(
-                "{subquestion}",
-                textwrap.indent(sub_questions[k], " " * 4),
-            )
-            .replace(
-                "{markscheme}",
-                textwrap.indent(this_markscheme, " " * 4),
-            )
-            .replace(
-                "{mark_types_explanation}",
-                textwrap.indent(
-                    extract_mark_type_explanation(
-                        f"_{k}" if k != "_" else "",
-                        markscheme[k],
-                    ),
-                    " " * 4,
-                ),
-            )
-            .replace(
-                "{answer}",
-                textwrap.indent(answer[k], " " * 4),
-            )
-            .replace(
-                "{available_marks}",
-                str(available_marks[k.replace("_", "total")]),
-            )
-            .replace(
-                "{output_response_explanation}",
-                output_response_explanation,
-            )
-            .replace(
-                "{prior_context}",
-                (
-                    (
-                        prior_context_exp
-                        + pretty_print_dict(
-                            {
-                                k: {
-                                    "sub-question": sub_questions[k],
-                                    "markscheme": markscheme[k],
-                                    "answer": answer[k],
-                                }
-                                for k in list(sub_questions.keys())[0:i]
-                            },
-                            indent=4,
-                        )
-                    )
-                    if with_subqs and i > 0
-                    else ""
-                ),
-            ),
-        )
-        mark_sys_msgs.append(
-            mark_system_message.replace(
-                "{subq}",
-                k.replace("_", str(question_num)),
-            )
-            .replace(
-                "{question}",
-                textwrap.indent(question, " " * 4),
-            )
-            .replace(
-                "{subquestion}",
-                textwrap.indent(sub_questions[k], " " * 4),
-            )
-            .replace(
-                "{answer}",
-                textwrap.indent(answer[k], " " * 4),
-            )
-            .replace(
-                "{prior_context}",
-                (
-                    (
-                        prior_context_exp
-                        + pretty_print_dict(
-                            {
-                                k: {
-                                    "sub-question": sub_questions[k],
-                                    "markscheme": markscheme[k],
-                                    "answer": answer[k],
-                                }
-                                for k in list(sub_questions.keys())[0:i]
-                            },
-                            indent=4,
-                        )
-                    )
-                    if with_subqs and i > 0
-                    else ""
-                ),
-            ),
+    parsed_markschemes, subq_sys_msgs, mark_sys_msgs, batched_mark_sys_msgs = (
+        render_system_messages(
+            subq_system_message,
+            mark_system_message,
+            question_num,
+            question,
+            sub_questions,
+            markscheme,
+            answer,
+            available_marks,
         )
+    )
     rets = unify.map(
         lambda *a: call_subq_agent(example_id, *a),
         list(sub_questions.keys()),
         list(subq_agents.values()),
         list(markscheme.values()),
         parsed_markschemes,
+        subq_sys_msgs,
         mark_sys_msgs,
+        batched_mark_sys_msgs,
         from_args=True,
         name=f"Evals[{example_id}]->SubQAgent",
     )
@@ -565,24 +778,86 @@ def evaluate(
     return error_total
 
 
-with unify.Experiment(
-    "clarify_method_marks",
-    overwrite=True,
-), unify.Params(
-    subq_system_message=subq_system_message,
-    mark_system_message=mark_system_message,
-    dataset="TestSet10",
-    source=unify.get_source(),
-):
-    unify.map(
-        evaluate,
-        [
-            dict(
-                **d.entries,
-                _subq_system_message=subq_system_message,
-                _mark_system_message=mark_system_message,
-            )
-            for d in test_set_10
-        ],
-        name="Evals",
+# only run as a script, so that the prompt rendering can be imported by the tests
+if __name__ == "__main__":
+    unify.activate("MarkingAssistant")
+    unify.set_context("Evals")
+
+    agent = unify.Unify("o3-mini@openai", traced=True, cache="read-only")
+
+    fetch_cache()
+
+    test_set_10 = load_dataset("TestSet10")
+
+    cache_index = RequestIndex(open_store(".cache.json"))
+    cache_telemetry = CacheTelemetry(cache_index)
+    incremental = IncrementalEvaluator(
+        "clarify_method_marks",
+        previous="queries_per_mark",
+        telemetry=cache_telemetry,
+        dry_run=estimate_only,
+        cache=cache_index,
     )
+    prefix_stats = PrefixStats()
+
+    if estimate_only:
+        entries = [d.entries for d in test_set_10]
+        unify.map(
+            call_agent,
+            [e["example_id"] for e in entries],
+            [subq_system_message] * len(entries),
+            [mark_system_message] * len(entries),
+            *[
+                [e[k] for e in entries]
+                for k in (
+                    "question_num",
+                    "question",
+                    "sub_questions",
+                    "markscheme",
+                    "student_answer",
+                    "available_marks",
+                )
+            ],
+            from_args=True,
+            name="Estimate",
+        )
+        print(
+            f"{incremental.issued} changed units, of which {len(incremental.pending)} "
+            f"are not in the cache and need live calls",
+        )
+    else:
+        with unify.Experiment(
+            "clarify_method_marks",
+            overwrite=True,
+        ), unify.Params(
+            subq_system_message=subq_system_message,
+            mark_system_message=mark_system_message,
+            batch_marks=batch_marks,
+            static_first_layout=static_first_layout,
+            dataset="TestSet10",
+            source=unify.get_source(),
+        ):
+            unify.map(
+                evaluate,
+                [
+                    dict(
+                        **d.entries,
+                        _subq_system_message=subq_system_message,
+                        _mark_system_message=mark_system_message,
+                    )
+                    for d in test_set_10
+                ],
+                name="Evals",
+            )
+            print(
+                cache_telemetry.summary(
+                    (
+                        NearMissIndex(open_store(".cache.json"))
+                        if cache_telemetry.misses
+                        else None
+                    ),
+                ),
+            )
+
+        incremental.save()
+        print(prefix_stats.summary())
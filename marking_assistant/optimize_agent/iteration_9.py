@@ -1,11 +1,11 @@
 import json
-import os
 import re
 import textwrap
 
 import unify
-import wget
+from incremental import IncrementalEvaluator
 from pydantic import BaseModel
+from shared import fetch_cache, load_dataset
 
 unify.activate("MarkingAssistant")
 unify.set_context("Evals")
@@ -14,16 +14,14 @@ unify.set_context("Evals")
 agent = unify.Unify("o3-mini@openai", traced=True, cache="read-only")
 
 
-if os.path.exists(".cache.json"):
-    os.remove(".cache.json")
-wget.download(
-    "https://raw.githubusercontent.com/"
-    "unifyai/demos/refs/heads/main/"
-    "marking_assistant/.cache.json",
-)
+fetch_cache()
+
+
+test_set_10 = load_dataset("TestSet10")
 
 
-test_set_10 = unify.download_dataset("TestSet10")
+# records the fingerprint of every unit, so iteration_10 can copy unchanged ones
+incremental = IncrementalEvaluator("queries_per_mark")
 
 
 def pretty_print_dict(d, indent=0):
@@ -318,7 +316,13 @@ def call_subq_agent(
     if mark_agents:
         explanation = "An expert marker has already taken a look at the student's answer, and they have made the following observations for each of the candidate marks mentioned in the markscheme. You should pay special attention to these observations."
         vals = unify.map(
-            lambda i, m, a: json.loads(a.generate(tags=[m + f"({i})"])),
+            lambda i, m, a: json.loads(
+                incremental.generate(
+                    f"{example_id}/{subq}/{m}({i})",
+                    a,
+                    tags=[m + f"({i})"],
+                ),
+            ),
             [tuple([i] + item) for i, item in enumerate(mark_agents)],
             name=f"Evals[{example_id}]->SubQAgent[{subq}]->MarkAgent",
         )
@@ -344,7 +348,7 @@ def call_subq_agent(
             mark_observations,
         ),
     )
-    ret = subq_agent.generate(tags=[subq])
+    ret = incremental.generate(f"{example_id}/{subq}", subq_agent, tags=[subq])
     if "```" in ret:
         ret = ret.split("```")[-2].lstrip("json")
     ret = json.loads(ret)
@@ -578,3 +582,5 @@ with unify.Experiment(
         ],
         name="Evals",
     )
+
+incremental.save()
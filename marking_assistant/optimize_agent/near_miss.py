@@ -0,0 +1,107 @@
+import difflib
+import json
+import re
+
+import numpy as np
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+SHINGLE_SIZE = 5
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def _decode_key(key):
+    # cache keys embed the request as json, so compare against its string contents
+    start = min([i for i in (key.find("{"), key.find("[")) if i >= 0], default=-1)
+    if start < 0:
+        return key
+    try:
+        request = json.loads(key[start:])
+    except json.JSONDecodeError:
+        return key
+    strings = list()
+
+    def _collect(value):
+        if isinstance(value, str):
+            strings.append(value)
+        elif isinstance(value, dict):
+            [_collect(v) for v in value.values()]
+        elif isinstance(value, list):
+            [_collect(v) for v in value]
+
+    _collect(request)
+    return "\n".join(strings)
+
+
+def _words(text):
+    return re.findall(r"\S+", text)
+
+
+def word_edit_distance(a, b):
+    """Number of words inserted, deleted or replaced to turn `a` into `b`."""
+    matcher = difflib.SequenceMatcher(None, _words(a), _words(b), autojunk=False)
+    return sum(
+        max(i2 - i1, j2 - j1)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    )
+
+
+class NearMissIndex:
+    """
+    MinHash/LSH index over the requests held in a `CacheStore`, for finding the
+    closest cached request to a prompt which missed the cache, without comparing it
+    against every entry.
+    """
+
+    def __init__(self, store):
+        rng = np.random.default_rng(0)
+        self._a = rng.integers(1, MERSENNE_PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+        self._b = rng.integers(0, MERSENNE_PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+        self._texts = list()
+        self._buckets = dict()
+        for key in store.keys():
+            text = _decode_key(key)
+            self._add(len(self._texts), self._signature(text))
+            self._texts.append(text)
+
+    def _signature(self, text):
+        words = _words(text)
+        shingles = {
+            hash(" ".join(words[i : i + SHINGLE_SIZE])) & 0xFFFFFFFF
+            for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))
+        }
+        hashes = np.array(list(shingles), dtype=np.uint64)
+        permuted = (np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+    def _bands(self, signature):
+        return [
+            (band, signature[band * ROWS : (band + 1) * ROWS].tobytes())
+            for band in range(BANDS)
+        ]
+
+    def _add(self, idx, signature):
+        for band in self._bands(signature):
+            self._buckets.setdefault(band, list()).append(idx)
+
+    def _candidates(self, prompt):
+        candidates = set()
+        for band in self._bands(self._signature(prompt)):
+            candidates.update(self._buckets.get(band, list()))
+        return candidates
+
+    def nearest(self, prompt):
+        """
+        Returns the closest cached request text and its word edit distance from the
+        prompt, or `(None, None)` if no cached request shares an LSH bucket with it.
+        """
+        candidates = self._candidates(prompt)
+        if not candidates:
+            return None, None
+        distances = {
+            idx: word_edit_distance(self._texts[idx], prompt) for idx in candidates
+        }
+        idx = min(distances, key=distances.get)
+        return self._texts[idx], distances[idx]
@@ -1,19 +1,105 @@
 import argparse
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import unify
+import wget
+from shared import CACHE_URL, SHARED_CACHE_ENV, SHARED_DATASET_ENV, dump_dataset
 
+unify.activate("MarkingAssistant")
 unify.set_context("Evals", overwrite=True)
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 
 args = argparse.ArgumentParser()
 args.add_argument("--iteration", type=int, default=11)
+args.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of iterations to run concurrently",
+)
 args = args.parse_args()
 
-for i in range(args.iteration):
+# one cache and dataset snapshot, shared by all iterations
+snapshot_dir = tempfile.mkdtemp(prefix="optimize_agent_")
+cache_path = wget.download(CACHE_URL, out=snapshot_dir)
+dataset_path = os.path.join(snapshot_dir, "TestSet10.json")
+dump_dataset("TestSet10", dataset_path)
+env = {
+    **os.environ,
+    SHARED_CACHE_ENV: os.path.abspath(cache_path),
+    SHARED_DATASET_ENV: dataset_path,
+}
+
+print_lock = threading.Lock()
+
+# iterations which copy forward the fingerprinted responses of earlier ones, and so
+# only start once those have finished: iteration_10 reuses the "queries_per_mark"
+# responses which iteration_9 saves, and would otherwise re-issue every call
+dependencies = {10: [9]}
+assert all(
+    d < i for i, deps in dependencies.items() for d in deps
+), "Iterations can only depend on earlier ones, which are started first"
+finished = {i: threading.Event() for i in range(args.iteration)}
+
+
+def run_iteration(i):
+    try:
+        for d in dependencies.get(i, list()):
+            if d in finished:
+                finished[d].wait()
+        return _run_iteration(i)
+    finally:
+        finished[i].set()
+
+
+def _run_iteration(i):
     script_name = f"{this_dir}/iteration_{i}.py"
-    print(f"Running {script_name}...")
-    subprocess.run(["python", script_name], check=True)
-    print(f"Finished {script_name}\n")
+    # each iteration gets its own working directory for .cache.json etc.
+    work_dir = os.path.join(snapshot_dir, f"iteration_{i}")
+    os.makedirs(work_dir, exist_ok=True)
+    with print_lock:
+        print(f"Running {script_name}...")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        ["python", script_name],
+        cwd=work_dir,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    for line in process.stdout:
+        with print_lock:
+            print(f"[iteration_{i}] {line}", end="")
+    returncode = process.wait()
+    duration = time.perf_counter() - start
+    with print_lock:
+        print(f"Finished {script_name} in {duration:.1f}s\n")
+    return i, returncode, duration
+
+
+start = time.perf_counter()
+with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    results = list(executor.map(run_iteration, range(args.iteration)))
+wall_clock = time.perf_counter() - start
+shutil.rmtree(snapshot_dir)
+
+print(f"\n{'iteration':<12}{'status':<10}{'time (s)':>10}")
+for i, returncode, duration in results:
+    status = "ok" if returncode == 0 else f"failed ({returncode})"
+    print(f"{f'iteration_{i}':<12}{status:<10}{duration:>10.1f}")
+print(
+    f"\nwall-clock {wall_clock:.1f}s, "
+    f"serial equivalent {sum(r[2] for r in results):.1f}s",
+)
+
+failed = [i for i, returncode, _ in results if returncode != 0]
+if failed:
+    raise SystemExit(f"Iterations {failed} failed")
@@ -0,0 +1,60 @@
+import json
+import os
+import types
+
+import requests
+import unify
+import wget
+from cache_store import CacheStore
+
+CACHE_URL = (
+    "https://raw.githubusercontent.com/"
+    "unifyai/demos/refs/heads/main/"
+    "marking_assistant/.cache.json"
+)
+
+# set by optimize_agent.py, so that parallel iterations share one snapshot of each
+SHARED_CACHE_ENV = "MARKING_ASSISTANT_SHARED_CACHE"
+SHARED_DATASET_ENV = "MARKING_ASSISTANT_SHARED_DATASET"
+
+
+def fetch_cache():
+    shared_cache = os.environ.get(SHARED_CACHE_ENV)
+    if shared_cache:
+        if os.path.lexists(".cache.json"):
+            os.remove(".cache.json")
+        os.symlink(shared_cache, ".cache.json")
+        return
+    # only download again if the remote cache changed since the last import
+    store = CacheStore()
+    etag = requests.head(CACHE_URL).headers.get("ETag")
+    if (
+        etag
+        and etag == store.get_meta("etag")
+        and os.path.isfile(".cache.json")
+        and not os.path.islink(".cache.json")
+    ):
+        store.close()
+        return
+    if os.path.lexists(".cache.json"):
+        os.remove(".cache.json")
+    wget.download(CACHE_URL)
+    # replace rather than extend the entries, so deleted entries do not linger
+    store.clear()
+    store.import_json(".cache.json")
+    if etag:
+        store.set_meta("etag", etag)
+    store.close()
+
+
+def load_dataset(name):
+    shared_dataset = os.environ.get(SHARED_DATASET_ENV)
+    if not shared_dataset:
+        return unify.download_dataset(name)
+    with open(shared_dataset) as file:
+        return [types.SimpleNamespace(entries=entries) for entries in json.load(file)]
+
+
+def dump_dataset(name, fpath):
+    with open(fpath, "w+") as file:
+        file.write(json.dumps([d.entries for d in unify.download_dataset(name)]))
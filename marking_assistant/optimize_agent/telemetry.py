@@ -0,0 +1,108 @@
+import difflib
+import textwrap
+import threading
+import time
+
+
+class CacheTelemetry:
+    """
+    Counts cache hits and misses per agent family (e.g. "subq" or "mark") for agents
+    created with `cache="read-only"`, where a miss silently becomes a live call.
+    unify does not report whether a response came from the cache, so each call is
+    looked up in the `cache` (a `RequestIndex`) before it is made.
+    """
+
+    def __init__(self, cache, top_n=5):
+        self._cache = cache
+        self._top_n = top_n
+        self._lock = threading.Lock()
+        self._stats = dict()
+        self._hit_prompts = dict()
+        self._missed_prompts = dict()
+
+    def _family_stats(self, family):
+        return self._stats.setdefault(
+            family,
+            dict(
+                hits=0,
+                misses=0,
+                copied=0,
+                bytes=0,
+                hit_latency=0.0,
+                miss_latency=0.0,
+            ),
+        )
+
+    def generate(self, family, agent, **kwargs):
+        hit = self._cache.contains(agent, **kwargs)
+        start = time.perf_counter()
+        response = agent.generate(**kwargs)
+        latency = time.perf_counter() - start
+        with self._lock:
+            stats = self._family_stats(family)
+            stats["hits" if hit else "misses"] += 1
+            stats["hit_latency" if hit else "miss_latency"] += latency
+            stats["bytes"] += len(response.encode())
+            prompts = self._hit_prompts if hit else self._missed_prompts
+            prompts.setdefault(family, list()).append(agent.system_message)
+        return response
+
+    def record_copied(self, family):
+        with self._lock:
+            self._family_stats(family)["copied"] += 1
+
+    @property
+    def misses(self):
+        return sum(stats["misses"] for stats in self._stats.values())
+
+    def _nearest_diff(self, family, prompt):
+        candidates = self._hit_prompts.get(family, list())
+        if not candidates:
+            return "    (no cached prompt to compare against)"
+        nearest = max(
+            candidates,
+            key=lambda c: difflib.SequenceMatcher(None, c, prompt).quick_ratio(),
+        )
+        diff = difflib.unified_diff(
+            nearest.splitlines(),
+            prompt.splitlines(),
+            "nearest cached",
+            "missed",
+            lineterm="",
+            n=1,
+        )
+        return "\n".join("    " + line for line in diff)
+
+    def summary(self, index=None):
+        """
+        If a `NearMissIndex` is passed, each listed miss is compared against the
+        closest entry in the whole cache, otherwise against the closest prompt which
+        hit the cache during this run.
+        """
+        lines = list()
+        for family, stats in self._stats.items():
+            hits, misses = stats["hits"], stats["misses"]
+            live_latency = stats["miss_latency"] / misses if misses else None
+            saved = (
+                f"~{hits * live_latency - stats['hit_latency']:.1f}s"
+                if live_latency is not None
+                else "unknown (no live calls)"
+            )
+            lines.append(
+                f"{family}: {hits} hits, {misses} misses, {stats['copied']} copied "
+                f"forward, {stats['bytes']} bytes, latency saved {saved}",
+            )
+            for prompt in self._missed_prompts.get(family, list())[0 : self._top_n]:
+                if index is None:
+                    lines.append(self._nearest_diff(family, prompt))
+                    continue
+                nearest, distance = index.nearest(prompt)
+                lines.append(
+                    (
+                        f"    nearest cached entry is {distance} words away:\n"
+                        + textwrap.indent(textwrap.shorten(nearest, 200), " " * 8)
+                        if nearest is not None
+                        else "    (no similar cached entry)"
+                    ),
+                )
+        return "\n".join(lines)
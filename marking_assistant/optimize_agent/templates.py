@@ -0,0 +1,131 @@
+import bisect
+import os
+import re
+import threading
+
+SLOT_PATTERN = re.compile(r"\{(\w+)\}")
+
+# rough rule of thumb for English text with the OpenAI tokenizers
+CHARS_PER_TOKEN = 4
+
+
+class PromptTemplate(str):
+    """
+    A prompt template which is split into static segments and `{slot}` names once,
+    on construction. Binding slots with `partial` merges them into the neighbouring
+    static segments, and `render` then builds the final prompt with a single join,
+    rather than a chain of full-string `.replace` copies.
+
+    The string value is always the template with any unbound slots left in place,
+    so it can still be logged, compared and hashed exactly like the original string.
+    """
+
+    def __new__(cls, template, _parts=None):
+        if _parts is None:
+            _parts = list()
+            pos = 0
+            for match in SLOT_PATTERN.finditer(template):
+                _parts.append(template[pos : match.start()])
+                _parts.append(match.group(1))
+                pos = match.end()
+            _parts.append(template[pos:])
+        self = super().__new__(cls, template)
+        # even indices are static segments, odd indices are slot names
+        self._parts = _parts
+        return self
+
+    @property
+    def slots(self):
+        return set(self._parts[1::2])
+
+    def _substitute(self, values):
+        parts = list()
+        static = [self._parts[0]]
+        for i in range(1, len(self._parts), 2):
+            name = self._parts[i]
+            if name in values:
+                static += [str(values[name]), self._parts[i + 1]]
+            else:
+                parts += ["".join(static), name]
+                static = [self._parts[i + 1]]
+        parts.append("".join(static))
+        return parts
+
+    def partial(self, **values):
+        parts = self._substitute(values)
+        template = "".join(
+            part if i % 2 == 0 else "{" + part + "}" for i, part in enumerate(parts)
+        )
+        return PromptTemplate(template, _parts=parts)
+
+    def render(self, **values):
+        return "".join(
+            (
+                part
+                if i % 2 == 0
+                else str(values[part]) if part in values else "{" + part + "}"
+            )
+            for i, part in enumerate(self._parts)
+        )
+
+
+class PrefixRenderer:
+    """
+    Renders the concatenation of the first `n` items of a sequence, extending the
+    previously rendered text by one item at a time, so that rendering every prefix
+    of the sequence only renders each item once.
+    """
+
+    def __init__(self, render_item):
+        self._render_item = render_item
+        self._prefixes = [""]
+
+    def render(self, n):
+        while len(self._prefixes) <= n:
+            i = len(self._prefixes) - 1
+            self._prefixes.append(self._prefixes[i] + self._render_item(i))
+        return self._prefixes[n]
+
+
+class PrefixStats:
+    """
+    Records every rendered prompt per family (e.g. "subq" or "mark"), and reports how
+    much of each prompt is a prefix shared with a previously sent prompt, which is
+    the part a provider-side prompt cache could reuse.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prompts = dict()
+        self._stats = dict()
+
+    def record(self, family, prompt):
+        with self._lock:
+            prompts = self._prompts.setdefault(family, list())
+            # the longest shared prefix is always with a neighbour in sorted order
+            idx = bisect.bisect_left(prompts, prompt)
+            shared = max(
+                [
+                    len(os.path.commonprefix([prompt, prompts[j]]))
+                    for j in (idx - 1, idx)
+                    if 0 <= j < len(prompts)
+                ],
+                default=0,
+            )
+            prompts.insert(idx, prompt)
+            stats = self._stats.setdefault(family, [0, 0])
+            stats[0] += shared
+            stats[1] += len(prompt)
+
+    def summary(self):
+        lines = list()
+        for family, prompts in self._prompts.items():
+            common = len(os.path.commonprefix([prompts[0], prompts[-1]]))
+            shared, total = self._stats[family]
+            lines.append(
+                f"{family}: {len(prompts)} prompts, "
+                f"~{common // CHARS_PER_TOKEN} tokens shared by all, "
+                f"~{shared // CHARS_PER_TOKEN}/{total // CHARS_PER_TOKEN} tokens "
+                f"({100 * shared / max(total, 1):.1f}%) reusable from earlier prompts",
+            )
+        return "\n".join(lines)
@@ -0,0 +1,108 @@
+import json
+import sqlite3
+import types
+
+import pytest
+from cache_store import CacheStore, RequestIndex, hash_key, open_store
+from pydantic import BaseModel
+
+
+class MarksAndReasoning(BaseModel):
+    reasoning: str
+    marks: int
+
+
+def _agent(system_message):
+    return types.SimpleNamespace(
+        endpoint="o3-mini@openai",
+        system_message=system_message,
+        response_format=MarksAndReasoning,
+    )
+
+
+def _cache_key(system_message):
+    # as unify serializes the kwargs of the create call, with client defaults
+    kwargs = {
+        "model": "o3-mini@openai",
+        "messages": [{"role": "system", "content": system_message}],
+        "temperature": 1.0,
+        "response_format": json.dumps(MarksAndReasoning.model_json_schema()),
+        "extra_body": {"signature": "python", "use_custom_keys": False},
+    }
+    return "chat.completions.create_" + json.dumps(kwargs)
+
+
+def _completion(content):
+    return {
+        "id": "chatcmpl-0",
+        "object": "chat.completion",
+        "model": "o3-mini@openai",
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            },
+        ],
+    }
+
+
+@pytest.fixture
+def cache_json(tmp_path):
+    content = json.dumps({"reasoning": "correct method", "marks": 2})
+    fpath = tmp_path / ".cache.json"
+    fpath.write_text(
+        json.dumps(
+            {
+                # the value is the completion json-encoded as a string
+                _cache_key("marking question 1"): json.dumps(_completion(content)),
+                # newer caches wrap that string next to its types
+                _cache_key("marking question 2"): {
+                    "value": json.dumps(_completion(content)),
+                    "res_types": {"[]": "ChatCompletion"},
+                },
+            },
+            indent=4,
+        ),
+    )
+    return str(fpath), content
+
+
+@pytest.mark.parametrize("system_message", ["marking question 1", "marking question 2"])
+def test_response_of_cached_request(cache_json, system_message):
+    fpath, content = cache_json
+    store = open_store(fpath)
+    index = RequestIndex(store)
+    assert index.contains(_agent(system_message))
+    assert index.response(_agent(system_message)) == content
+    store.close()
+
+
+def test_response_of_uncached_request(cache_json):
+    fpath, _ = cache_json
+    store = open_store(fpath)
+    index = RequestIndex(store)
+    assert not index.contains(_agent("marking question 3"))
+    assert index.response(_agent("marking question 3")) is None
+    store.close()
+
+
+def test_request_column_of_older_store(tmp_path):
+    # stores written before the request column existed are backfilled on open
+    db_path = str(tmp_path / ".cache.db")
+    content = json.dumps({"reasoning": "correct method", "marks": 2})
+    key = _cache_key("marking question 1")
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute(
+            "CREATE TABLE entries "
+            "(hash TEXT PRIMARY KEY, key TEXT NOT NULL, value TEXT NOT NULL)",
+        )
+        conn.execute(
+            "INSERT INTO entries VALUES (?, ?, ?)",
+            (hash_key(key), key, json.dumps(json.dumps(_completion(content)))),
+        )
+    conn.close()
+    store = CacheStore(db_path)
+    assert RequestIndex(store).response(_agent("marking question 1")) == content
+    store.close()
@@ -0,0 +1,232 @@
+import json
+import os
+import textwrap
+
+import pytest
+
+unify = pytest.importorskip("unify")
+if not hasattr(unify, "traced"):
+    pytest.skip("needs a unify client with tracing", allow_module_level=True)
+
+import iteration_10
+from iteration_10 import (
+    extract_mark_type_explanation,
+    mark_system_message,
+    output_response_explanation,
+    parse_marks_from_markscheme,
+    pretty_print_dict,
+    prior_context_exp,
+    render_mark_system_messages,
+    render_system_messages,
+    subq_system_message,
+)
+
+TEST_SET = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "..",
+    "data",
+    "test_set.json",
+)
+
+
+def chained_replace_system_messages(
+    subq_system_message,
+    mark_system_message,
+    question_num,
+    question,
+    sub_questions,
+    markscheme,
+    answer,
+    available_marks,
+    mark_observations,
+):
+    """
+    The sub-question and mark system messages of each sub-question, rendered with
+    the chained `.replace` calls which the templates replaced.
+    """
+    with_subqs = len(markscheme) > 1
+    subq_sys_msgs = list()
+    mark_sys_msgs = list()
+    for i, k in enumerate(markscheme.keys()):
+        parsed_markscheme = parse_marks_from_markscheme(
+            f"_{k}" if k != "_" else "",
+            markscheme[k],
+        )
+        this_markscheme = markscheme[k]
+        for i, (mark, chunk) in enumerate(parsed_markscheme):
+            this_markscheme = this_markscheme.replace(
+                chunk,
+                chunk.replace(
+                    mark,
+                    f"{mark}({len([m for m, _ in parsed_markscheme[0:i] if m == mark])})",
+                ),
+            )
+        prior_context = (
+            (
+                prior_context_exp
+                + pretty_print_dict(
+                    {
+                        k: {
+                            "sub-question": sub_questions[k],
+                            "markscheme": markscheme[k],
+                            "answer": answer[k],
+                        }
+                        for k in list(sub_questions.keys())[0:i]
+                    },
+                    indent=4,
+                )
+            )
+            if with_subqs and i > 0
+            else ""
+        )
+        subq_sys_msgs.append(
+            subq_system_message.replace(
+                "{subq}",
+                k.replace("_", str(question_num)),
+            )
+            .replace(
+                "{question}",
+                textwrap.indent(question, " " * 4),
+            )
+            .replace(
+                "{subquestion}",
+                textwrap.indent(sub_questions[k], " " * 4),
+            )
+            .replace(
+                "{markscheme}",
+                textwrap.indent(this_markscheme, " " * 4),
+            )
+            .replace(
+                "{mark_types_explanation}",
+                textwrap.indent(
+                    extract_mark_type_explanation(
+                        f"_{k}" if k != "_" else "",
+                        markscheme[k],
+                    ),
+                    " " * 4,
+                ),
+            )
+            .replace(
+                "{answer}",
+                textwrap.indent(answer[k], " " * 4),
+            )
+            .replace(
+                "{available_marks}",
+                str(available_marks[k.replace("_", "total")]),
+            )
+            .replace(
+                "{output_response_explanation}",
+                output_response_explanation,
+            )
+            .replace(
+                "{prior_context}",
+                prior_context,
+            )
+            .replace(
+                "{mark_observations}",
+                mark_observations,
+            ),
+        )
+        mark_sys_msg = (
+            mark_system_message.replace(
+                "{subq}",
+                k.replace("_", str(question_num)),
+            )
+            .replace(
+                "{question}",
+                textwrap.indent(question, " " * 4),
+            )
+            .replace(
+                "{subquestion}",
+                textwrap.indent(sub_questions[k], " " * 4),
+            )
+            .replace(
+                "{answer}",
+                textwrap.indent(answer[k], " " * 4),
+            )
+            .replace(
+                "{prior_context}",
+                prior_context,
+            )
+        )
+        mark_sys_msgs.append(
+            [
+                mark_sys_msg.replace(
+                    "{mark}",
+                    mk,
+                )
+                .replace(
+                    "{markscheme}",
+                    textwrap.indent(
+                        markscheme[k].replace(
+                            v,
+                            v.replace(mk, f"**{mk}** (to consider!)"),
+                        ),
+                        " " * 4,
+                    ),
+                )
+                .replace(
+                    "{mark_types_explanation}",
+                    extract_mark_type_explanation(
+                        f"_{mk}({j})" if mk != "_" else "",
+                        markscheme[k],
+                        [mk],
+                    ),
+                )
+                for j, (mk, v) in enumerate(parsed_markscheme)
+            ],
+        )
+    return subq_sys_msgs, mark_sys_msgs
+
+
+with open(TEST_SET) as file:
+    examples = json.load(file)
+
+
+@pytest.mark.skipif(
+    iteration_10.static_first_layout,
+    reason="only the default layout predates the templates",
+)
+@pytest.mark.parametrize(
+    "example",
+    examples,
+    ids=[str(e["example_id"]) for e in examples],
+)
+def test_prompts_match_chained_replace(example):
+    # the cached responses were generated from these prompts, so any change to
+    # them turns every cache hit into a live call
+    args = [
+        example["question_num"],
+        example["question"],
+        example["sub_questions"],
+        example["markscheme"],
+        example["student_answer"],
+        example["available_marks"],
+    ]
+    parsed_markschemes, subq_sys_msgs, mark_sys_msgs, _ = render_system_messages(
+        subq_system_message,
+        mark_system_message,
+        *args,
+    )
+    expected_subq_sys_msgs, expected_mark_sys_msgs = chained_replace_system_messages(
+        str(subq_system_message),
+        str(mark_system_message),
+        *args,
+        mark_observations="{observations}",
+    )
+    for k, subq_sys_msg, mark_sys_msg, parsed_markscheme in zip(
+        example["markscheme"].keys(),
+        subq_sys_msgs,
+        mark_sys_msgs,
+        parsed_markschemes,
+    ):
+        prompts = [
+            subq_sys_msg.render(mark_observations="{observations}"),
+        ] + render_mark_system_messages(
+            mark_sys_msg,
+            example["markscheme"][k],
+            parsed_markscheme,
+        )
+        expected = [expected_subq_sys_msgs.pop(0)] + expected_mark_sys_msgs.pop(0)
+        assert prompts == expected, f"renders different prompts for {k}"
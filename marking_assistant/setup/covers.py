@@ -0,0 +1,36 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+
+
+def _scan_pages(pdf_path, start, stop, markers):
+    reader = PdfReader(pdf_path)
+    flags = list()
+    for page in reader.pages[start:stop]:
+        text_stripped = page.extract_text().lower().replace(" ", "")
+        flags.append([marker in text_stripped for marker in markers])
+    return flags
+
+
+def find_marked_pages(pdf_path, markers, processes=None):
+    """
+    Returns a list of flags for each page of the pdf, stating which of the `markers`
+    appear in the page text, lower-cased and with spaces removed. The pages are
+    scanned in contiguous chunks across a process pool, with one reader per process.
+    """
+    num_pages = len(PdfReader(pdf_path).pages)
+    processes = min(processes or os.cpu_count(), num_pages)
+    chunk_size = -(-num_pages // processes)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(
+                _scan_pages,
+                pdf_path,
+                start,
+                min(start + chunk_size, num_pages),
+                markers,
+            )
+            for start in range(0, num_pages, chunk_size)
+        ]
+        return [flags for future in futures for flags in future.result()]
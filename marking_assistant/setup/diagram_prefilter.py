@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+from pages import PageLayouts
+
+# pages with vector graphics, but less non-text ink than this (as a fraction of the
+# page), only use them for brackets, arrows and the like rather than a diagram
+MAX_TEXT_ONLY_INK = 0.002
+# straight runs longer than this fraction of the page width are answer lines, table
+# rules or boxes rather than diagrams
+MIN_RULE_LENGTH = 0.25
+
+
+def page_features(img, words, page_width, page_height):
+    """
+    Cheap pixel features of a rendered page, given the pdfplumber word boxes (in
+    pdf points) of the same page:
+
+    - `non_text_ink`: the fraction of the page covered by ink outside of any word
+      box, after removing long horizontal and vertical rules
+    - `largest_component`: the bounding box area of the largest connected
+      component of that ink, as a fraction of the page
+    - `rule_density`: the fraction of all ink which belongs to long rules
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    height, width = gray.shape
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    total_ink = max(int(np.count_nonzero(ink)), 1)
+
+    rule_length = int(width * MIN_RULE_LENGTH)
+    rules = cv2.bitwise_or(
+        cv2.morphologyEx(ink, cv2.MORPH_OPEN, np.ones((1, rule_length), np.uint8)),
+        cv2.morphologyEx(ink, cv2.MORPH_OPEN, np.ones((rule_length, 1), np.uint8)),
+    )
+    rule_density = np.count_nonzero(rules) / total_ink
+    ink = cv2.subtract(ink, rules)
+
+    scale_x, scale_y = width / page_width, height / page_height
+    for word in words:
+        ink[
+            max(int(word["top"] * scale_y) - 2, 0) : int(word["bottom"] * scale_y) + 2,
+            max(int(word["x0"] * scale_x) - 2, 0) : int(word["x1"] * scale_x) + 2,
+        ] = 0
+
+    num_components, _, stats, _ = cv2.connectedComponentsWithStats(ink, 8)
+    areas = stats[1:, cv2.CC_STAT_WIDTH] * stats[1:, cv2.CC_STAT_HEIGHT]
+    return dict(
+        non_text_ink=np.count_nonzero(ink) / ink.size,
+        largest_component=(areas.max() if num_components > 1 else 0) / ink.size,
+        rule_density=rule_density,
+    )
+
+
+def prefilter(graphics, render, words, page_width, page_height):
+    """
+    Returns False for pages which confidently do not contain a diagram, and None
+    for ambiguous pages, which should be sent to the LLM. `render` is only called,
+    to rasterize the page, for pages with vector graphics but no embedded images.
+
+    Pages with embedded images are always ambiguous. In the labelled papers about
+    as many of them have no diagram in any question as have one, and no pixel
+    feature separates the two confidently.
+    """
+    if not any(graphics.values()):
+        return False
+    if graphics["images"]:
+        return None
+    features = page_features(render(), words, page_width, page_height)
+    if features["non_text_ink"] < MAX_TEXT_ONLY_INK:
+        return False
+    return None
+
+
+def _labelled_pages(parsed_dir):
+    with open(os.path.join(parsed_dir, "parsed.json")) as file:
+        parsed = json.load(file)
+    positives = {
+        int(fname[len("page") : -len(".png")])
+        for question in parsed.values()
+        for fname in question.get("images", [])
+    }
+    pages = {pg for question in parsed.values() for pg in question["pages"]}
+    return {pg: pg in positives for pg in sorted(pages)}
+
+
+def benchmark(root):
+    """
+    Compares the pre-filter against the `images` of every `parsed.json` under
+    `root`. A page is labelled as containing a diagram if any question on it has
+    that page in its `images`. Pages outside of all questions are not labelled.
+    """
+    counts = dict(tp=0, fp=0, tn=0, fn=0, ambiguous_p=0, ambiguous_n=0)
+    for dirpath, _, fnames in os.walk(root):
+        if "parsed.json" not in fnames or not os.path.exists(dirpath + ".pdf"):
+            continue
+        layouts = PageLayouts(dirpath + ".pdf")
+        for pg, label in _labelled_pages(dirpath).items():
+            decision = prefilter(
+                layouts.graphics(pg - 1),
+                lambda: cv2.imread(os.path.join(dirpath, "imgs", f"page{pg}.png")),
+                layouts.words(pg - 1),
+                *layouts.size(pg - 1),
+            )
+            if decision is None:
+                counts["ambiguous_" + "np"[label]] += 1
+                continue
+            counts[("t" if decision == label else "f") + "np"[decision]] += 1
+            if decision != label:
+                print(f"{dirpath} page {pg}: predicted {decision}, labelled {label}")
+        layouts.close()
+    ambiguous = counts["ambiguous_p"] + counts["ambiguous_n"]
+    decided = sum(counts.values()) - ambiguous
+    # the LLM is assumed to be right on the ambiguous pages it is sent
+    tp, fn = counts["tp"] + counts["ambiguous_p"], counts["fn"]
+    print(
+        f"{decided} pages decided locally, {ambiguous} sent to the LLM "
+        f"({decided / max(decided + ambiguous, 1):.0%} of calls saved)\n"
+        f"diagram recall {tp / max(tp + fn, 1):.2f}, "
+        f"text-only precision {counts['tn'] / max(counts['tn'] + fn, 1):.2f}\n"
+        f"{counts}",
+    )
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--root",
+        default=os.path.join(os.path.dirname(__file__), "..", "data", "parsed"),
+        type=str,
+    )
+    args = parser.parse_args()
+    benchmark(args.root)
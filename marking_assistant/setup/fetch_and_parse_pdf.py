@@ -1,27 +1,60 @@
+import hashlib
 import json
 import os
 import re
-import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import cv2
-import numpy as np
-import pdfplumber
 import unify
 import wget
-from pdf2image import convert_from_path
+from pydantic import ValidationError
 from pypdf import PdfReader, PdfWriter
 
 unify.CLIENT_LOGGING = True
+from covers import find_marked_pages
+from diagram_prefilter import prefilter
 from helpers import (
     VALID_NUMERALS,
+    ClientPool,
+    build_fused_response_format,
     build_response_format,
-    encode_image,
+    guess_question_states,
     is_invalid_question_order,
     parse_key,
     prune_invalid_leading_alphanumeric_questions,
     update_str_in_table,
 )
+from journal import Journal, is_incomplete
+from markscheme_tables import markscheme_rows, parse_markscheme_rows
+from pages import PageImages, PageLayouts, file_sha256
 from prompts import *
+from question_layout import QuestionLayout
+from stages import Stages
+
+# render pages to disk and memory-map them, rather than holding them all in memory
+memmap_pages = False
+# extract the text and tables of all pages in background threads up front
+prefetch_layouts = False
+# downscale and re-encode the page images sent to vision calls. None keeps the full
+# resolution and default jpeg quality, so that the cached responses still match
+image_max_dim = None
+image_quality = None
+# send the pages without diagrams in grayscale, once diagram detection is done
+grayscale_text_pages = False
+# answer diagram detection locally for pages which confidently have no diagram
+prefilter_diagrams = False
+# number of detector clients shared by the concurrent parse_question workers
+detector_pool_size = 8
+# number of pages ahead of the current one whose detections are kept in flight
+detection_window = 4
+# parse each question, its components and whether it is text-only in a single call,
+# falling back to the three separate calls if the response does not validate
+fuse_question_parsing = False
+# detect the questions on each page from the layout of its words, and only ask the
+# LLM about pages where the layout is ambiguous
+structural_question_detection = False
+# read the answers and marks of each markscheme question from its table rows, and
+# only parse the questions whose rows are incomplete or unreadable from the images
+table_markschemes = False
 
 url = (
     "https://www.ocr.org.uk/Images/169000-foundation-tier-sample-assessment"
@@ -54,6 +87,20 @@ def prune_page_number(pg_text: str, page_num: int, question_num: int):
 
 
 def parse_pdf_into_papers_and_markschemes():
+    # the page ranges of each split are recorded against the hash of the bundle, so
+    # that splitting is skipped entirely when it has already been done
+    bundle_sha256 = file_sha256(pdf_path)
+    splits_fpath = os.path.join(pdf_dir, "splits.json")
+    if os.path.exists(splits_fpath):
+        with open(splits_fpath) as file:
+            prev_splits = json.load(file)
+        if prev_splits["sha256"] == bundle_sha256 and all(
+            os.path.exists(os.path.join(pdf_dir, str(count), f"{name}.pdf"))
+            for count, split in enumerate(prev_splits["splits"], 1)
+            for name in split
+        ):
+            return
+
     paper_cover_text = (
         "completetheboxesabovewithyourname,centrenumberandcandidatenumber."
     )
@@ -62,39 +109,43 @@ def parse_pdf_into_papers_and_markschemes():
     markscheme_cover_pages = list()
     looking_for_paper = True
 
-    for i, page in enumerate(reader.pages):
-        text_stripped = page.extract_text().lower().replace(" ", "")
-        if looking_for_paper and paper_cover_text in text_stripped:
+    cover_flags = find_marked_pages(
+        pdf_path,
+        [paper_cover_text, markscheme_cover_text],
+    )
+    for i, (paper_cover, markscheme_cover) in enumerate(cover_flags):
+        if looking_for_paper and paper_cover:
             paper_cover_pages.append(i)
             looking_for_paper = False
-        elif not looking_for_paper and markscheme_cover_text in text_stripped:
+        elif not looking_for_paper and markscheme_cover:
             markscheme_cover_pages.append(i)
             looking_for_paper = True
 
+    splits = list()
     left_pointer = paper_cover_pages.pop(0)
-    count = 1
     while paper_cover_pages or markscheme_cover_pages:
-        count_dir = os.path.join(pdf_dir, str(count))
-        os.makedirs(count_dir, exist_ok=True)
         # paper
-        writer = PdfWriter()
         right_pointer = markscheme_cover_pages.pop(0)
-        [writer.add_page(pg) for pg in reader.pages[left_pointer:right_pointer]]
-        paper_fpath = os.path.join(count_dir, "paper.pdf")
-        writer.write(paper_fpath)
+        paper_pages = [left_pointer, right_pointer]
         left_pointer = right_pointer
         # mark-scheme
-        writer = PdfWriter()
         if paper_cover_pages:
             right_pointer = paper_cover_pages.pop(0)
         else:
-            right_pointer = len(reader.pages) + 1
-        [writer.add_page(pg) for pg in reader.pages[left_pointer:right_pointer]]
-        markscheme_fpath = os.path.join(count_dir, "markscheme.pdf")
-        writer.write(markscheme_fpath)
+            right_pointer = len(reader.pages)
+        markscheme_pages = [left_pointer, right_pointer]
         left_pointer = right_pointer
-        # count
-        count += 1
+        splits.append(dict(paper=paper_pages, markscheme=markscheme_pages))
+
+    for count, split in enumerate(splits, 1):
+        count_dir = os.path.join(pdf_dir, str(count))
+        os.makedirs(count_dir, exist_ok=True)
+        for name, (start, stop) in split.items():
+            writer = PdfWriter()
+            [writer.add_page(pg) for pg in reader.pages[start:stop]]
+            writer.write(os.path.join(count_dir, f"{name}.pdf"))
+    with open(splits_fpath, "w+") as file:
+        file.write(json.dumps(dict(sha256=bundle_sha256, splits=splits), indent=4))
 
 
 def _fill_missing_questions_n_pages(questions_to_pages):
@@ -126,32 +177,53 @@ def _fill_missing_questions_n_pages(questions_to_pages):
     return dict(sorted(new_questions_to_pages.items()))
 
 
-def parse_paper(paper_num):
-    question_detector = unify.Unify(
-        "o1@openai",
-        cache=True,
-        system_message=QUESTION_DETECTION,
-        stateful=True,
-    )
-    diagram_detector = unify.Unify("o1@openai", cache=True)
-
+def parse_paper(paper_num, on_question_to_pages=None):
     paper_dir = os.path.join(pdf_dir, str(paper_num), "paper")
     os.makedirs(paper_dir, exist_ok=True)
     paper_path = paper_dir + ".pdf"
+    layouts = PageLayouts(paper_path, prefetch=prefetch_layouts)
+    journal = Journal(
+        os.path.join(paper_dir, "journal.jsonl"),
+        sha256=file_sha256(paper_path),
+    )
+    # the journal is closed even if parsing fails, so everything recorded up to
+    # the failure is on disk for the next run to resume from
+    try:
+        _parse_paper_pdf(paper_dir, layouts, journal, on_question_to_pages)
+        journal.mark_complete()
+    finally:
+        journal.close()
+        layouts.close()
+
 
-    reader = pdfplumber.open(paper_path)
+def _parse_paper_pdf(paper_dir, layouts, journal, on_question_to_pages):
+    diagram_detectors = ClientPool("o1@openai", size=detector_pool_size, cache=True)
+    paper_path = paper_dir + ".pdf"
+    question_layout = QuestionLayout(layouts) if structural_question_detection else None
     questions = dict()
 
-    all_images = [
-        np.asarray(img.getdata())
-        .reshape(img.size[1], img.size[0], 3)
-        .astype(
-            np.uint8,
+    page_images = PageImages(
+        paper_path,
+        os.path.join(paper_dir, "imgs"),
+        memmap_dir=os.path.join(paper_dir, "ppm") if memmap_pages else None,
+    )
+
+    diagram_pages = set()
+
+    def image_url(page_num, grayscale=False):
+        payload = page_images.encoded(
+            page_num - 1,
+            max_dim=image_max_dim,
+            quality=image_quality,
+            grayscale=grayscale,
         )
-        for img in convert_from_path(paper_path)
-    ]
+        return f"data:image/jpeg;base64,{payload}"
 
-    diagram_images = dict()
+    def question_image_url(page_num):
+        return image_url(
+            page_num,
+            grayscale=grayscale_text_pages and page_num not in diagram_pages,
+        )
 
     def parse_question_detector(response):
         parsed = (
@@ -177,177 +249,259 @@ def parse_paper(paper_num):
         )
         return [p for p in parsed if p != ""]
 
-    def parse_into_pages():
-        diagram_detector.set_system_message(DIAGRAM_DETECTION_ON_PAGE)
-        question_to_pages = dict()
-        latest_num = 0
-        latest_char = "`"
-        for page_num, page in enumerate(reader.pages):
-            page_num += 1
-            text = page.extract_text().split("OCR  2024  J560/0")[-1][2:]
-            text = prune_page_number(text, page_num, latest_num + 1)
-            # detect diagrams on page
-            img = all_images[page_num - 1]
-            diagram_response = diagram_detector.generate(
-                messages=[
+    def page_messages(text, page_num):
+        return [
+            {
+                "role": "user",
+                "content": [
                     {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": text,
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,"
-                                    f"{encode_image(img)}",
-                                },
-                            },
-                        ],
+                        "type": "text",
+                        "text": text,
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url(page_num),
+                        },
                     },
                 ],
+            },
+        ]
+
+    def detect_diagram(page_num, text):
+        # the text is pruned by the question number the page is guessed to start
+        # from, so a wrong guess is detected again rather than read back
+        key = f"{page_num}:{hashlib.sha256(text.encode()).hexdigest()[:16]}"
+        if ("diagram", key) in journal:
+            return journal.get("diagram", key)
+        if prefilter_diagrams:
+            contains_diagram = prefilter(
+                layouts.graphics(page_num - 1),
+                lambda: page_images[page_num - 1],
+                layouts.words(page_num - 1),
+                *layouts.size(page_num - 1),
             )
-            contains_diagram = "yes" in diagram_response.split("\n")[-1].strip().lower()
-            img_dir = os.path.join(paper_dir, "imgs")
-            os.makedirs(img_dir, exist_ok=True)
-            fname = f"page{page_num}.png"
-            if not os.path.exists(fname):
-                cv2.imwrite(os.path.join(img_dir, fname), img)
-            if contains_diagram:
-                diagram_images[page_num] = img
-            question_detector.set_messages([])  # clear previous chat
-            question_detector.set_system_message(
-                QUESTION_DETECTION.replace(
-                    "{n-1}",
-                    str(latest_num),
-                )
-                .replace(
-                    "{n0}",
-                    str(latest_num + 1),
-                )
-                .replace(
-                    "{n1}",
-                    str(latest_num + 2),
-                )
-                .replace(
-                    "{n2}",
-                    str(latest_num + 3),
-                )
-                .replace(
-                    "{c0}",
-                    chr(ord(latest_char) + 1),
-                )
-                .replace(
-                    "{c1}",
-                    chr(ord(latest_char) + 2),
-                )
-                .replace(
-                    "{c2}",
-                    chr(ord(latest_char) + 3),
-                )
-                .replace(
-                    "{explanation}",
-                    (
-                        f"did not have any alpha sub-questions, so we should see a "
-                        f"numeric question first on this page, possibly followed by `a`"
-                        if latest_char == "`"
-                        else f"ended with question {latest_num} {latest_char}"
-                    ),
-                ),
+            if contains_diagram is not None:
+                journal.record("diagram", key, contains_diagram)
+                return contains_diagram
+        diagram_detector = unify.Unify(
+            "o1@openai",
+            cache=True,
+            system_message=DIAGRAM_DETECTION_ON_PAGE,
+        )
+        diagram_response = diagram_detector.generate(
+            messages=page_messages(text, page_num),
+        )
+        contains_diagram = "yes" in diagram_response.split("\n")[-1].strip().lower()
+        journal.record("diagram", key, contains_diagram)
+        return contains_diagram
+
+    def detect_questions(page_num, raw_text, latest_num, latest_char):
+        # the detected questions depend on the state the page starts from
+        key = f"{page_num}:{latest_num}:{latest_char}"
+        if ("page", key) in journal:
+            return journal.get("page", key)
+        detected_qs = _detect_questions(page_num, raw_text, latest_num, latest_char)
+        journal.record("page", key, detected_qs)
+        return detected_qs
+
+    def _detect_questions(page_num, raw_text, latest_num, latest_char):
+        if question_layout is not None:
+            detected_qs = question_layout.detect(page_num - 1, latest_num, latest_char)
+            if detected_qs is not None:
+                return detected_qs
+        text = prune_page_number(raw_text, page_num, latest_num + 1)
+        question_detector = unify.Unify(
+            "o1@openai",
+            cache=True,
+            system_message=QUESTION_DETECTION.replace(
+                "{n-1}",
+                str(latest_num),
+            )
+            .replace(
+                "{n0}",
+                str(latest_num + 1),
+            )
+            .replace(
+                "{n1}",
+                str(latest_num + 2),
             )
+            .replace(
+                "{n2}",
+                str(latest_num + 3),
+            )
+            .replace(
+                "{c0}",
+                chr(ord(latest_char) + 1),
+            )
+            .replace(
+                "{c1}",
+                chr(ord(latest_char) + 2),
+            )
+            .replace(
+                "{c2}",
+                chr(ord(latest_char) + 3),
+            )
+            .replace(
+                "{explanation}",
+                (
+                    f"did not have any alpha sub-questions, so we should see a "
+                    f"numeric question first on this page, possibly followed by `a`"
+                    if latest_char == "`"
+                    else f"ended with question {latest_num} {latest_char}"
+                ),
+            ),
+            stateful=True,
+        )
+        response = question_detector.generate(
+            messages=page_messages(text, page_num),
+        )
+        assert len(question_detector.messages) == 2
+        detected_qs = parse_question_detector(response)
+        if not all(
+            v.isdigit() or (len(v) == 1 and v.isalpha()) or v in VALID_NUMERALS
+            for v in detected_qs
+        ):
+            return None
+        invalid_sequence = is_invalid_question_order(
+            detected_qs,
+            str(latest_num + 1),
+            chr(ord(latest_char) + 1),
+        )
+        count = 0
+        attempts = 3
+        while invalid_sequence and count < attempts:
             response = question_detector.generate(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": text,
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,"
-                                    f"{encode_image(img)}",
-                                },
-                            },
-                        ],
-                    },
-                ],
+                f"The previous response {detected_qs} was invalid. "
+                f"The next question *number* must be {latest_num + 1}, "
+                "and if the *first* item on the page is a letter (before any "
+                f"numbers) then it must be {chr(ord(latest_char) + 1)} (as an "
+                f"overflow of question {latest_num} from the previous page). "
+                "Finally, any letters immediately after a new question number "
+                "*must* begin with `a` and then ascend alphabetically one character "
+                f"at a time. Your answer of {detected_qs} does not adhere to "
+                f"these rules. Perhaps you mistook the page number {page_num} for "
+                "the question number, and the letter refers to a prior question? "
+                "Other similar mistakes might be possible. Please have another "
+                "think and provide an updated answer.",
             )
-            assert len(question_detector.messages) == 2
             detected_qs = parse_question_detector(response)
             if not all(
                 v.isdigit() or (len(v) == 1 and v.isalpha()) or v in VALID_NUMERALS
                 for v in detected_qs
             ):
+                detected_qs = response
+                count += 1
+                assert len(question_detector.messages) == 2 + count * 2
                 continue
             invalid_sequence = is_invalid_question_order(
                 detected_qs,
                 str(latest_num + 1),
                 chr(ord(latest_char) + 1),
             )
-            count = 0
-            attempts = 3
-            while invalid_sequence and count < attempts:
-                response = question_detector.generate(
-                    f"The previous response {detected_qs} was invalid. "
-                    f"The next question *number* must be {latest_num + 1}, "
-                    "and if the *first* item on the page is a letter (before any "
-                    f"numbers) then it must be {chr(ord(latest_char) + 1)} (as an "
-                    f"overflow of question {latest_num} from the previous page). "
-                    "Finally, any letters immediately after a new question number "
-                    "*must* begin with `a` and then ascend alphabetically one character "
-                    f"at a time. Your answer of {detected_qs} does not adhere to "
-                    f"these rules. Perhaps you mistook the page number {page_num} for "
-                    "the question number, and the letter refers to a prior question? "
-                    "Other similar mistakes might be possible. Please have another "
-                    "think and provide an updated answer.",
-                )
-                detected_qs = parse_question_detector(response)
-                if not all(
-                    v.isdigit() or (len(v) == 1 and v.isalpha()) or v in VALID_NUMERALS
-                    for v in detected_qs
+            count += 1
+            assert len(question_detector.messages) == 2 + count * 2
+        assert (
+            not invalid_sequence
+        ), f"Still an invalid sequence {detected_qs} after {attempts} attempts"
+        return detected_qs
+
+    def parse_into_pages():
+        question_to_pages = dict()
+        latest_num = 0
+        latest_char = "`"
+        texts = [
+            layouts.text(i).split("OCR  2024  J560/0")[-1][2:]
+            for i in range(len(layouts))
+        ]
+        # diagram detection is independent per page, and question detection is
+        # issued ahead of the current page from a guess of the state each page
+        # starts from, and only re-issued for the pages where the guess turns out
+        # wrong. Only a few pages are in flight at once, so that the detections of
+        # pages after a wrong guess can still be cancelled before they start
+        guesses = guess_question_states(texts)
+        diagram_futures = dict()
+        question_futures = dict()
+        executor = ThreadPoolExecutor(max_workers=2 * detection_window)
+
+        def submit(page_num):
+            text = texts[page_num - 1]
+            num, char = guesses[page_num - 1]
+            diagram_futures[page_num] = executor.submit(
+                detect_diagram,
+                page_num,
+                prune_page_number(text, page_num, num + 1),
+            )
+            question_futures[page_num] = executor.submit(
+                detect_questions,
+                page_num,
+                text,
+                num,
+                char,
+            )
+
+        try:
+            for page_num, text in enumerate(texts, 1):
+                for ahead in range(
+                    page_num,
+                    min(page_num + detection_window, len(texts) + 1),
                 ):
-                    detected_qs = response
-                    count += 1
-                    assert len(question_detector.messages) == 2 + count * 2
-                    continue
-                invalid_sequence = is_invalid_question_order(
-                    detected_qs,
-                    str(latest_num + 1),
-                    chr(ord(latest_char) + 1),
-                )
-                count += 1
-                assert len(question_detector.messages) == 2 + count * 2
-            assert (
-                not invalid_sequence
-            ), f"Still an invalid sequence {detected_qs} after {attempts} attempts"
-            num = latest_num
-            char = latest_char
-            for i, item in enumerate(detected_qs):
-                if item in VALID_NUMERALS:
-                    question_to_pages[f"{num}.{char}.{item}"] = [page_num]
-                elif item.isalpha():
-                    if (
-                        len(detected_qs) == i + 1
-                        or (
-                            detected_qs[i + 1] not in VALID_NUMERALS
-                            and detected_qs[i + 1].isalpha()
-                        )
-                        or detected_qs[i + 1].isdigit()
-                    ):
-                        question_to_pages[f"{num}.{item}"] = [page_num]
-                    char = item
-                elif item.isdigit():
-                    if len(detected_qs) == i + 1 or detected_qs[i + 1].isdigit():
-                        question_to_pages[item] = [page_num]
-                    num = int(item)
+                    if ahead not in question_futures:
+                        submit(ahead)
+                guessed_num, guessed_char = guesses[page_num - 1]
+                if (guessed_num, guessed_char) == (latest_num, latest_char):
+                    detected_qs = question_futures[page_num].result()
                 else:
-                    raise ValueError(f"Invalid type for question: {item}")
-            latest_num = num
-            latest_char = "`" if detected_qs[-1].isnumeric() else char
+                    question_futures[page_num].cancel()
+                    text_for_diagram = prune_page_number(text, page_num, latest_num + 1)
+                    if text_for_diagram != prune_page_number(
+                        text,
+                        page_num,
+                        guessed_num + 1,
+                    ):
+                        diagram_futures[page_num].cancel()
+                        diagram_futures[page_num] = executor.submit(
+                            detect_diagram,
+                            page_num,
+                            text_for_diagram,
+                        )
+                    detected_qs = detect_questions(
+                        page_num,
+                        text,
+                        latest_num,
+                        latest_char,
+                    )
+                if not detected_qs:
+                    continue
+                num = latest_num
+                char = latest_char
+                for i, item in enumerate(detected_qs):
+                    if item in VALID_NUMERALS:
+                        question_to_pages[f"{num}.{char}.{item}"] = [page_num]
+                    elif item.isalpha():
+                        if (
+                            len(detected_qs) == i + 1
+                            or (
+                                detected_qs[i + 1] not in VALID_NUMERALS
+                                and detected_qs[i + 1].isalpha()
+                            )
+                            or detected_qs[i + 1].isdigit()
+                        ):
+                            question_to_pages[f"{num}.{item}"] = [page_num]
+                        char = item
+                    elif item.isdigit():
+                        if len(detected_qs) == i + 1 or detected_qs[i + 1].isdigit():
+                            question_to_pages[item] = [page_num]
+                        num = int(item)
+                    else:
+                        raise ValueError(f"Invalid type for question: {item}")
+                latest_num = num
+                latest_char = "`" if detected_qs[-1].isnumeric() else char
+            for page_num, future in diagram_futures.items():
+                if future.result():
+                    diagram_pages.add(page_num)
+        finally:
+            executor.shutdown(cancel_futures=True)
         return _fill_missing_questions_n_pages(question_to_pages), latest_num
 
     question_to_pages, num_questions = parse_into_pages()
@@ -356,10 +510,70 @@ def parse_paper(paper_num):
     )
     with open(os.path.join(paper_dir, "question_to_pages.json"), "w+") as file:
         file.write(json.dumps(question_to_pages, indent=4))
-
-    json_file_lock = threading.Lock()
+    # the markscheme only needs the question to pages mapping, so it can be parsed
+    # alongside the questions of the paper
+    if on_question_to_pages is not None:
+        on_question_to_pages()
 
     def parse_question(question_num: int):
+        if ("question", question_num) in journal:
+            questions[question_num] = journal.get("question", question_num)
+            return
+        _parse_question(question_num)
+        journal.record("question", question_num, questions[question_num])
+
+    def parse_question_fused(question_num, sub_questions, current_text, img_urls):
+        """
+        Extracts the question, its components and whether it is text-only in a single
+        call, or returns None if the response does not validate.
+        """
+        response_format = build_fused_response_format(question_num, sub_questions)
+        question_parser = unify.Unify(
+            "o1@openai",
+            cache=True,
+            system_message=FUSED_QUESTION_PARSER.replace(
+                "{question_number}",
+                str(question_num),
+            )
+            .replace(
+                "{preceding}",
+                str(question_num - 1),
+            )
+            .replace(
+                "{subsequent}",
+                str(question_num + 1),
+            ),
+        )
+        question_parser.set_response_format(response_format)
+        response = question_parser.generate(
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": current_text,
+                        },
+                    ]
+                    + [
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": url,
+                            },
+                        }
+                        for url in img_urls
+                    ],
+                },
+            ],
+        )
+        try:
+            parsed = response_format.model_validate_json(response)
+        except ValidationError:
+            return None
+        return parsed.question, parsed.components.model_dump(), parsed.text_only
+
+    def parse_question_chained(question_num, sub_questions, current_text, img_urls):
         question_parser = unify.Unify("o1@openai", cache=True)
         question_component_parser = unify.Unify(
             "o1@openai",
@@ -371,19 +585,6 @@ def parse_paper(paper_num):
             cache=True,
             system_message=TEXT_ONLY_DETECTION,
         )
-        sub_questions = [
-            ".".join(k.split(".")[1:])
-            for k, v in question_to_pages.items()
-            if k.startswith(str(question_num) + ".")
-        ]
-        pages = [
-            v
-            for k, v in question_to_pages.items()
-            if (k == str(question_num) or k.startswith(str(question_num) + "."))
-        ]
-        pages = list(dict.fromkeys([item for sublist in pages for item in sublist]))
-        current_text = "".join([reader.pages[pg - 1].extract_text() for pg in pages])
-        imgs = [all_images[pg - 1] for pg in pages]
         question_parser.set_system_message(
             QUESTION_PARSER.replace(
                 "{question_number}",
@@ -412,11 +613,10 @@ def parse_paper(paper_num):
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,"
-                                f"{encode_image(img)}",
+                                "url": url,
                             },
                         }
-                        for img in imgs
+                        for url in img_urls
                     ],
                 },
             ],
@@ -440,16 +640,47 @@ def parse_paper(paper_num):
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,"
-                                f"{encode_image(img)}",
+                                "url": url,
                             },
                         }
-                        for img in imgs
+                        for url in img_urls
                     ],
                 },
             ],
         )
         text_only = "yes" in response.split("\n")[-1].lower()
+        return question_parsed, question_comp_parsed, text_only
+
+    def _parse_question(question_num: int):
+        sub_questions = [
+            ".".join(k.split(".")[1:])
+            for k, v in question_to_pages.items()
+            if k.startswith(str(question_num) + ".")
+        ]
+        pages = [
+            v
+            for k, v in question_to_pages.items()
+            if (k == str(question_num) or k.startswith(str(question_num) + "."))
+        ]
+        pages = list(dict.fromkeys([item for sublist in pages for item in sublist]))
+        current_text = "".join([layouts.text(pg - 1) for pg in pages])
+        img_urls = [question_image_url(pg) for pg in pages]
+        parsed = None
+        if fuse_question_parsing:
+            parsed = parse_question_fused(
+                question_num,
+                sub_questions,
+                current_text,
+                img_urls,
+            )
+        if parsed is None:
+            parsed = parse_question_chained(
+                question_num,
+                sub_questions,
+                current_text,
+                img_urls,
+            )
+        question_parsed, question_comp_parsed, text_only = parsed
         questions[question_num] = {
             "question": question_parsed,
             "question-components": (
@@ -461,93 +692,136 @@ def parse_paper(paper_num):
             "pages": pages,
             "correctly_parsed": True,
         }
-        parsed = json.dumps(dict(sorted(questions.items())), indent=4)
-        json_file_lock.acquire()
-        with open(os.path.join(paper_dir, "parsed.json"), "w+") as file:
-            file.write(parsed)
-        json_file_lock.release()
 
         # image
-        imgs = [diagram_images[pg] for pg in pages if pg in diagram_images]
-        if not imgs:
+        img_urls = [image_url(pg) for pg in pages if pg in diagram_pages]
+        if not img_urls:
             return
-        diagram_detector.set_system_message(
-            DIAGRAM_DETECTION_IN_QUESTION.replace(
-                "{question_number}",
-                str(question_num),
-            )
-            .replace(
-                "{preceding}",
-                str(question_num - 1),
+        with diagram_detectors.client() as diagram_detector:
+            diagram_detector.set_system_message(
+                DIAGRAM_DETECTION_IN_QUESTION.replace(
+                    "{question_number}",
+                    str(question_num),
+                )
+                .replace(
+                    "{preceding}",
+                    str(question_num - 1),
+                )
+                .replace(
+                    "{subsequent}",
+                    str(question_num + 1),
+                ),
             )
-            .replace(
-                "{subsequent}",
-                str(question_num + 1),
-            ),
-        )
-        diagram_response = diagram_detector.generate(
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": current_text,
-                        },
-                    ]
-                    + [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encode_image(img)}",
+            diagram_response = diagram_detector.generate(
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": current_text,
                             },
-                        }
-                        for img in imgs
-                    ],
-                },
-            ],
-        )
+                        ]
+                        + [
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": url,
+                                },
+                            }
+                            for url in img_urls
+                        ],
+                    },
+                ],
+            )
         contains_diagram = "yes" in diagram_response.split("\n")[-1].strip().lower()
         # incrementally save to file
         if not contains_diagram:
             return
-        img_dir = os.path.join(paper_dir, "imgs")
-        os.makedirs(img_dir, exist_ok=True)
-        fnames = [f"page{pg}.png" for pg in pages if pg in diagram_images]
+        fnames = [f"page{pg}.png" for pg in pages if pg in diagram_pages]
         questions[question_num]["images"] = fnames
-        for fname, img in zip(fnames, imgs):
-            if not os.path.exists(fname):
-                cv2.imwrite(os.path.join(img_dir, fname), img)
 
     unify.map(parse_question, list(range(1, num_questions + 1)))
-    reader.close()
+    # each finished question is already in the journal, so parsed.json is only
+    # materialized once, after all of them
+    with open(os.path.join(paper_dir, "parsed.json"), "w+") as file:
+        file.write(json.dumps(dict(sorted(questions.items())), indent=4))
 
 
 def parse_markscheme(paper_num, question_to_subquestions, subquestions):
+    markscheme_dir = os.path.join(pdf_dir, str(paper_num), "markscheme")
+    os.makedirs(markscheme_dir, exist_ok=True)
+    markscheme_path = markscheme_dir + ".pdf"
+    paper_path = os.path.join(pdf_dir, str(paper_num), "paper.pdf")
+    layouts = PageLayouts(markscheme_path, prefetch=prefetch_layouts)
+    # the pages and questions detected in the markscheme depend on the questions
+    # parsed from the paper, so the journal is only valid for both of them
+    fingerprint = json.dumps(
+        [
+            file_sha256(markscheme_path),
+            file_sha256(paper_path),
+            question_to_subquestions,
+            subquestions,
+        ],
+    )
+    journal = Journal(
+        os.path.join(markscheme_dir, "journal.jsonl"),
+        sha256=hashlib.sha256(fingerprint.encode()).hexdigest(),
+    )
+    # the journal is closed even if parsing fails, so everything recorded up to
+    # the failure is on disk for the next run to resume from
+    try:
+        _parse_markscheme_pdf(
+            markscheme_dir,
+            layouts,
+            journal,
+            question_to_subquestions,
+            subquestions,
+        )
+        journal.mark_complete()
+    finally:
+        journal.close()
+        layouts.close()
+
+
+def _parse_markscheme_pdf(
+    markscheme_dir,
+    layouts,
+    journal,
+    question_to_subquestions,
+    subquestions,
+):
     qna_detector = unify.Unify(
         "o1@openai",
         cache=True,
         system_message=QUESTION_ANSWER_DETECTION,
     )
-    diagram_detector = unify.Unify("o1@openai", cache=True)
-
-    markscheme_dir = os.path.join(pdf_dir, str(paper_num), "markscheme")
-    os.makedirs(markscheme_dir, exist_ok=True)
+    diagram_detectors = ClientPool("o1@openai", size=detector_pool_size, cache=True)
     markscheme_path = markscheme_dir + ".pdf"
-
-    reader = pdfplumber.open(markscheme_path)
     questions = dict()
 
-    all_images = [
-        np.asarray(img.getdata())
-        .reshape(img.size[1], img.size[0], 3)
-        .astype(
-            np.uint8,
+    page_images = PageImages(
+        markscheme_path,
+        os.path.join(markscheme_dir, "imgs"),
+        memmap_dir=os.path.join(markscheme_dir, "ppm") if memmap_pages else None,
+    )
+
+    diagram_pages = set()
+
+    def image_url(page_num, grayscale=False):
+        payload = page_images.encoded(
+            page_num - 1,
+            max_dim=image_max_dim,
+            quality=image_quality,
+            grayscale=grayscale,
         )
-        for img in convert_from_path(markscheme_path)
-    ]
+        return f"data:image/jpeg;base64,{payload}"
 
-    diagram_images = dict()
+    def question_image_url(page_num):
+        return image_url(
+            page_num,
+            grayscale=grayscale_text_pages and page_num not in diagram_pages,
+        )
 
     def parse_question_detector(response):
         parsed = (
@@ -580,165 +854,209 @@ def parse_markscheme(paper_num, question_to_subquestions, subquestions):
         result.reverse()
         return [c for c in result if c != ""]
 
-    def parse_into_pages():
-        diagram_detector.set_system_message(
-            DIAGRAM_DETECTION_ON_PAGE.replace("questions", "questions or answers"),
+    def page_text(idx):
+        text = layouts.text(idx).split("OCR  2024  J560/0")[-1][2:]
+        # remove assessment objectives
+        text = re.sub(r"\d+\s+AO[123]\.\w+", "", text)
+        table = layouts.table(idx)
+        if table:
+            table = update_str_in_table(
+                table,
+                lambda x: re.sub(r"\d+\s+AO[123]\.\w+", "", x),
+            )
+            text = (
+                f"**Pure text representation:**\n{text}\n\n"
+                f"**Extracted table:**\n{json.dumps(table, indent=4)}"
+            )
+        return text
+
+    def detect_diagram(page_num, text):
+        if ("diagram", page_num) in journal:
+            return journal.get("diagram", page_num)
+        if prefilter_diagrams:
+            contains_diagram = prefilter(
+                layouts.graphics(page_num - 1),
+                lambda: page_images[page_num - 1],
+                layouts.words(page_num - 1),
+                *layouts.size(page_num - 1),
+            )
+            if contains_diagram is not None:
+                journal.record("diagram", page_num, contains_diagram)
+                return contains_diagram
+        diagram_detector = unify.Unify(
+            "o1@openai",
+            cache=True,
+            system_message=DIAGRAM_DETECTION_ON_PAGE.replace(
+                "questions",
+                "questions or answers",
+            ),
+        )
+        diagram_response = diagram_detector.generate(
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": text,
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url(page_num),
+                            },
+                        },
+                    ],
+                },
+            ],
         )
+        contains_diagram = "yes" in diagram_response.split("\n")[-1].strip().lower()
+        journal.record("diagram", page_num, contains_diagram)
+        return contains_diagram
+
+    def parse_into_pages():
         question_to_pages = dict()
         all_detected_qs = list()
         latest_num = 0
         latest_char = "`"
-        for page_num, page in enumerate(reader.pages):
-            page_num += 1
-            text = page.extract_text().split("OCR  2024  J560/0")[-1][2:]
-            # remove assessment objectives
-            text = re.sub(r"\d+\s+AO[123]\.\w+", "", text)
-            table = page.extract_table()
-            if table:
-                table = update_str_in_table(
-                    table,
-                    lambda x: re.sub(r"\d+\s+AO[123]\.\w+", "", x),
-                )
-                text = (
-                    f"**Pure text representation:**\n{text}\n\n"
-                    f"**Extracted table:**\n{json.dumps(table, indent=4)}"
-                )
-
-            # detect diagrams on page
-            img = all_images[page_num - 1]
-            diagram_response = diagram_detector.generate(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": text,
-                            },
+        texts = [page_text(i) for i in range(len(layouts))]
+        # diagram detection does not depend on the previous pages, so the next few
+        # pages are detected concurrently while the questions are detected page by
+        # page, and the pages after the last question are never started
+        executor = ThreadPoolExecutor(max_workers=detection_window)
+        diagram_futures = list()
+        try:
+            for page_num, text in enumerate(texts):
+                page_num += 1
+                ahead = min(page_num - 1 + detection_window, len(texts))
+                while len(diagram_futures) < ahead:
+                    diagram_futures.append(
+                        executor.submit(
+                            detect_diagram,
+                            len(diagram_futures) + 1,
+                            texts[len(diagram_futures)],
+                        ),
+                    )
+                # the detected questions depend on all questions detected before
+                key = f"{page_num}:{len(all_detected_qs)}"
+                if ("page", key) in journal:
+                    detected_qs = journal.get("page", key)
+                else:
+                    qna_detector.set_system_message(
+                        QUESTION_ANSWER_DETECTION.replace(
+                            "{detected_so_far}",
+                            (
+                                "the full set of questions detected so far up to and "
+                                f"including the last page are: {all_detected_qs}"
+                                if all_detected_qs
+                                else "this is the first page in the markscheme"
+                            ),
+                        )
+                        .replace(
+                            "{i0}",
+                            str(subquestions[0]),
+                        )
+                        .replace(
+                            "{i1}",
+                            str(subquestions[1] if len(subquestions) > 1 else ""),
+                        )
+                        .replace(
+                            "{i2}",
+                            str(subquestions[2] if len(subquestions) > 2 else ""),
+                        )
+                        .replace(
+                            "{n0}",
+                            str(latest_num + 1),
+                        )
+                        .replace(
+                            "{n1}",
+                            str(latest_num + 2),
+                        )
+                        .replace(
+                            "{n2}",
+                            str(latest_num + 3),
+                        )
+                        .replace(
+                            "{full_question_structure}",
+                            json.dumps(question_to_subquestions, indent=4),
+                        )
+                        .replace(
+                            "{subquestions}",
+                            ", ".join([str(sq) for sq in subquestions]),
+                        ),
+                    )
+                    response = qna_detector.generate(
+                        messages=[
                             {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,"
-                                    f"{encode_image(img)}",
-                                },
+                                "role": "user",
+                                "content": [
+                                    {
+                                        "type": "text",
+                                        "text": text,
+                                    },
+                                    {
+                                        "type": "image_url",
+                                        "image_url": {
+                                            "url": image_url(page_num),
+                                        },
+                                    },
+                                ],
                             },
                         ],
-                    },
-                ],
-            )
-            contains_diagram = "yes" in diagram_response.split("\n")[-1].strip().lower()
-            img_dir = os.path.join(markscheme_dir, "imgs")
-            os.makedirs(img_dir, exist_ok=True)
-            fname = f"page{page_num}.png"
-            if not os.path.exists(fname):
-                cv2.imwrite(os.path.join(img_dir, fname), img)
-            if contains_diagram:
-                diagram_images[page_num] = img
-            qna_detector.set_system_message(
-                QUESTION_ANSWER_DETECTION.replace(
-                    "{detected_so_far}",
-                    (
-                        "the full set of questions detected so far up to and including "
-                        f"the last page are: {all_detected_qs}"
-                        if all_detected_qs
-                        else "this is the first page in the markscheme"
-                    ),
-                )
-                .replace(
-                    "{i0}",
-                    str(subquestions[0]),
-                )
-                .replace(
-                    "{i1}",
-                    str(subquestions[1] if len(subquestions) > 1 else ""),
-                )
-                .replace(
-                    "{i2}",
-                    str(subquestions[2] if len(subquestions) > 2 else ""),
-                )
-                .replace(
-                    "{n0}",
-                    str(latest_num + 1),
-                )
-                .replace(
-                    "{n1}",
-                    str(latest_num + 2),
-                )
-                .replace(
-                    "{n2}",
-                    str(latest_num + 3),
-                )
-                .replace(
-                    "{full_question_structure}",
-                    json.dumps(question_to_subquestions, indent=4),
+                    )
+                    detected_qs = parse_question_detector(response)
+                    journal.record("page", key, detected_qs)
+                if not all(
+                    v.isdigit() or (len(v) == 1 and v.isalpha()) or v in VALID_NUMERALS
+                    for v in detected_qs
+                ):
+                    continue
+                assert detected_qs
+                detected_qs = prune_invalid_leading_alphanumeric_questions(detected_qs)
+                if not detected_qs:
+                    continue
+                paper_subquestions = [
+                    str(sq) for sq in subquestions[0 : len(detected_qs)]
+                ]
+                # ToDo: maybe turn this assertion into repeated LLM calls until they match
+                assert paper_subquestions == detected_qs, (
+                    f"Subquestions parsed from paper {paper_subquestions} do not match "
+                    f"those parsed from the markscheme {detected_qs} for page {page_num}"
                 )
-                .replace(
-                    "{subquestions}",
-                    ", ".join([str(sq) for sq in subquestions]),
-                ),
-            )
-            response = qna_detector.generate(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": text,
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,"
-                                    f"{encode_image(img)}",
-                                },
-                            },
-                        ],
-                    },
-                ],
-            )
-            detected_qs = parse_question_detector(response)
-            if not all(
-                v.isdigit() or (len(v) == 1 and v.isalpha()) or v in VALID_NUMERALS
-                for v in detected_qs
-            ):
-                continue
-            assert detected_qs
-            detected_qs = prune_invalid_leading_alphanumeric_questions(detected_qs)
-            paper_subquestions = [str(sq) for sq in subquestions[0 : len(detected_qs)]]
-            # ToDo: maybe turn this assertion into repeated LLM calls until they match
-            assert paper_subquestions == detected_qs, (
-                f"Subquestions parsed from paper {paper_subquestions} do not match "
-                f"those parsed from the markscheme {detected_qs} for page {page_num}"
-            )
-            [subquestions.pop(0) for _ in range(len(detected_qs))]
-            num = latest_num
-            char = latest_char
-            for i, item in enumerate(detected_qs):
-                if item in VALID_NUMERALS:
-                    question_to_pages[f"{num}.{char}.{item}"] = [page_num]
-                elif item.isalpha():
-                    if (
-                        len(detected_qs) == i + 1
-                        or (
-                            detected_qs[i + 1] not in VALID_NUMERALS
-                            and detected_qs[i + 1].isalpha()
-                        )
-                        or detected_qs[i + 1].isdigit()
-                    ):
-                        question_to_pages[f"{num}.{item}"] = [page_num]
-                    char = item
-                elif item.isdigit():
-                    if len(detected_qs) == i + 1 or detected_qs[i + 1].isdigit():
-                        question_to_pages[item] = [page_num]
-                    num = int(item)
-                else:
-                    raise ValueError(f"Invalid type for question: {item}")
-            latest_num = num
-            latest_char = "`" if detected_qs[-1].isnumeric() else char
-            all_detected_qs += detected_qs
-            if not subquestions:
-                break
+                [subquestions.pop(0) for _ in range(len(detected_qs))]
+                num = latest_num
+                char = latest_char
+                for i, item in enumerate(detected_qs):
+                    if item in VALID_NUMERALS:
+                        question_to_pages[f"{num}.{char}.{item}"] = [page_num]
+                    elif item.isalpha():
+                        if (
+                            len(detected_qs) == i + 1
+                            or (
+                                detected_qs[i + 1] not in VALID_NUMERALS
+                                and detected_qs[i + 1].isalpha()
+                            )
+                            or detected_qs[i + 1].isdigit()
+                        ):
+                            question_to_pages[f"{num}.{item}"] = [page_num]
+                        char = item
+                    elif item.isdigit():
+                        if len(detected_qs) == i + 1 or detected_qs[i + 1].isdigit():
+                            question_to_pages[item] = [page_num]
+                        num = int(item)
+                    else:
+                        raise ValueError(f"Invalid type for question: {item}")
+                latest_num = num
+                latest_char = "`" if detected_qs[-1].isnumeric() else char
+                all_detected_qs += detected_qs
+                if not subquestions:
+                    break
+            # pages after the last question are not part of the markscheme
+            for i, future in enumerate(diagram_futures[0:page_num]):
+                if future.result():
+                    diagram_pages.add(i + 1)
+        finally:
+            executor.shutdown(cancel_futures=True)
         return _fill_missing_questions_n_pages(question_to_pages), latest_num
 
     question_to_pages, num_questions = parse_into_pages()
@@ -747,29 +1065,24 @@ def parse_markscheme(paper_num, question_to_subquestions, subquestions):
     )
     with open(os.path.join(markscheme_dir, "question_to_pages.json"), "w+") as file:
         file.write(json.dumps(question_to_pages, indent=4))
-
-    json_file_lock = threading.Lock()
+    # the rows are read for all questions at once, since rows can run across pages
+    table_rows = dict()
+    if table_markschemes:
+        table_rows = markscheme_rows(
+            layouts,
+            sorted({pg for pages in question_to_pages.values() for pg in pages}),
+        )
 
     def parse_question(question_num: int):
+        if ("question", question_num) in journal:
+            questions[question_num] = journal.get("question", question_num)
+            return
+        _parse_question(question_num)
+        journal.record("question", question_num, questions[question_num])
+
+    def parse_question_from_images(question_num, sub_questions, current_text, img_urls):
         question_answer_parser = unify.Unify("o1@openai", cache=True)
         mark_breakdown_detector = unify.Unify("o1@openai", cache=True)
-        sub_questions = [
-            ".".join(k.split(".")[1:])
-            for k, v in question_to_pages.items()
-            if k.startswith(str(question_num) + ".")
-        ]
-        pages = [
-            v
-            for k, v in question_to_pages.items()
-            if (k == str(question_num) or k.startswith(str(question_num) + "."))
-        ]
-        pages = list(dict.fromkeys([item for sublist in pages for item in sublist]))
-        current_text = ""
-        for pg in pages:
-            pg_text = reader.pages[pg - 1].extract_text()
-            pg_text = prune_page_number(pg_text, pg, question_num)
-            current_text += pg_text
-        imgs = [all_images[pg - 1] for pg in pages]
         if sub_questions:
             sub_questions_expr = "sub-questions: " + ", ".join(sub_questions)
             fields_expr = "**all corresponding fields**"
@@ -815,11 +1128,10 @@ def parse_markscheme(paper_num, question_to_subquestions, subquestions):
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,"
-                                f"{encode_image(img)}",
+                                "url": url,
                             },
                         }
-                        for img in imgs
+                        for url in img_urls
                     ],
                 },
             ],
@@ -849,16 +1161,50 @@ def parse_markscheme(paper_num, question_to_subquestions, subquestions):
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,"
-                                f"{encode_image(img)}",
+                                "url": url,
                             },
                         }
-                        for img in imgs
+                        for url in img_urls
                     ],
                 },
             ],
         )
         mark_breakdown = json.loads(mark_breakdown)
+        return qna, mark_breakdown
+
+    def _parse_question(question_num: int):
+        sub_questions = [
+            ".".join(k.split(".")[1:])
+            for k, v in question_to_pages.items()
+            if k.startswith(str(question_num) + ".")
+        ]
+        pages = [
+            v
+            for k, v in question_to_pages.items()
+            if (k == str(question_num) or k.startswith(str(question_num) + "."))
+        ]
+        pages = list(dict.fromkeys([item for sublist in pages for item in sublist]))
+        current_text = ""
+        for pg in pages:
+            pg_text = layouts.text(pg - 1)
+            pg_text = prune_page_number(pg_text, pg, question_num)
+            current_text += pg_text
+        img_urls = [question_image_url(pg) for pg in pages]
+        parsed = None
+        if table_markschemes:
+            parsed = parse_markscheme_rows(
+                table_rows.get(question_num, dict()),
+                question_num,
+                sub_questions,
+            )
+        if parsed is None:
+            parsed = parse_question_from_images(
+                question_num,
+                sub_questions,
+                current_text,
+                img_urls,
+            )
+        qna, mark_breakdown = parsed
         total_marks = mark_breakdown["total"]
         sum_of_marks = sum([v for k, v in mark_breakdown.items() if k != "total"])
         assert not sub_questions or total_marks == sum_of_marks, (
@@ -871,117 +1217,132 @@ def parse_markscheme(paper_num, question_to_subquestions, subquestions):
             "pages": pages,
             "correctly_parsed": True,
         }
-        parsed = json.dumps(dict(sorted(questions.items())), indent=4)
-        json_file_lock.acquire()
-        with open(os.path.join(markscheme_dir, "parsed.json"), "w+") as file:
-            file.write(parsed)
-        json_file_lock.release()
 
         # image
-        imgs = [diagram_images[pg] for pg in pages if pg in diagram_images]
-        if not imgs:
+        img_urls = [image_url(pg) for pg in pages if pg in diagram_pages]
+        if not img_urls:
             return
-        diagram_detector.set_system_message(
-            DIAGRAM_DETECTION_IN_QUESTION.replace(
-                "{question_number}",
-                str(question_num),
-            )
-            .replace(
-                "{preceding}",
-                str(question_num - 1),
+        with diagram_detectors.client() as diagram_detector:
+            diagram_detector.set_system_message(
+                DIAGRAM_DETECTION_IN_QUESTION.replace(
+                    "{question_number}",
+                    str(question_num),
+                )
+                .replace(
+                    "{preceding}",
+                    str(question_num - 1),
+                )
+                .replace(
+                    "{subsequent}",
+                    str(question_num + 1),
+                ),
             )
-            .replace(
-                "{subsequent}",
-                str(question_num + 1),
-            ),
-        )
-        diagram_response = diagram_detector.generate(
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": current_text,
-                        },
-                    ]
-                    + [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encode_image(img)}",
+            diagram_response = diagram_detector.generate(
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": current_text,
                             },
-                        }
-                        for img in imgs
-                    ],
-                },
-            ],
-        )
+                        ]
+                        + [
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": url,
+                                },
+                            }
+                            for url in img_urls
+                        ],
+                    },
+                ],
+            )
         contains_diagram = "yes" in diagram_response.split("\n")[-1].strip().lower()
         # incrementally save to file
         if not contains_diagram:
             return
-        img_dir = os.path.join(markscheme_dir, "imgs")
-        os.makedirs(img_dir, exist_ok=True)
-        fnames = [f"page{pg}.png" for pg in pages if pg in diagram_images]
+        fnames = [f"page{pg}.png" for pg in pages if pg in diagram_pages]
         questions[question_num]["images"] = fnames
-        for fname, img in zip(fnames, imgs):
-            if not os.path.exists(fname):
-                cv2.imwrite(os.path.join(img_dir, fname), img)
 
     unify.map(parse_question, list(range(1, num_questions + 1)))
-    reader.close()
+    # each finished question is already in the journal, so parsed.json is only
+    # materialized once, after all of them
+    with open(os.path.join(markscheme_dir, "parsed.json"), "w+") as file:
+        file.write(json.dumps(dict(sorted(questions.items())), indent=4))
 
 
 if __name__ == "__main__":
     parse_pdf_into_papers_and_markschemes()
-    subdirs = sorted(os.listdir(pdf_dir))
+    subdirs = sorted(d for d in os.listdir(pdf_dir) if d.isdigit())
 
     def _parse(subdir: str):
+        stages = Stages()
 
         # paper
-        target_paper_fpath = os.path.join(pdf_dir, subdir, "paper/parsed.json")
-        if not os.path.exists(target_paper_fpath):
-            parse_paper(int(subdir))
-
-        target_q_to_pages_fpath = os.path.join(
-            pdf_dir,
-            subdir,
-            "paper/question_to_pages.json",
-        )
-        with open(target_q_to_pages_fpath) as f:
-            target_q_to_pages = json.load(f)
-        question_to_subquestions = dict()
-        subquestions = list()
-        next_char = "a"
-        for k in target_q_to_pages.keys():
-            if "." not in k:
-                question_to_subquestions[int(k)] = list()
-                subquestions.append(int(k))
-            else:
-                k_split = k.split(".")
-                q_num = k_split[0]
-                q_num = int(q_num)
-                if q_num not in question_to_subquestions:
-                    subquestions.append(q_num)
-                    next_char = "a"
-                    question_to_subquestions[q_num] = list()
-                letter = k_split[1]
-                if letter == next_char:
-                    subquestions.append(letter)
-                    next_char = chr(ord(letter) + 1)
-                if len(k_split) == 3:
-                    numeral = k_split[2]
-                    subquestions.append(numeral)
-                question_to_subquestions[q_num].append(".".join(k_split[1:]))
+        def _parse_paper(emit):
+            target_paper_fpath = os.path.join(pdf_dir, subdir, "paper/parsed.json")
+            paper_journal_fpath = os.path.join(pdf_dir, subdir, "paper/journal.jsonl")
+            if not os.path.exists(target_paper_fpath) or is_incomplete(
+                paper_journal_fpath,
+            ):
+                parse_paper(
+                    int(subdir),
+                    on_question_to_pages=lambda: emit("question_to_pages"),
+                )
+            emit("question_to_pages")
 
         # markscheme
-        target_markscheme_fpath = os.path.join(
-            pdf_dir,
-            subdir,
-            "markscheme/parsed.json",
-        )
-        if not os.path.exists(target_markscheme_fpath):
-            parse_markscheme(int(subdir), question_to_subquestions, subquestions)
+        def _parse_markscheme(emit):
+            target_q_to_pages_fpath = os.path.join(
+                pdf_dir,
+                subdir,
+                "paper/question_to_pages.json",
+            )
+            with open(target_q_to_pages_fpath) as f:
+                target_q_to_pages = json.load(f)
+            question_to_subquestions = dict()
+            subquestions = list()
+            next_char = "a"
+            for k in target_q_to_pages.keys():
+                if "." not in k:
+                    question_to_subquestions[int(k)] = list()
+                    subquestions.append(int(k))
+                else:
+                    k_split = k.split(".")
+                    q_num = k_split[0]
+                    q_num = int(q_num)
+                    if q_num not in question_to_subquestions:
+                        subquestions.append(q_num)
+                        next_char = "a"
+                        question_to_subquestions[q_num] = list()
+                    letter = k_split[1]
+                    if letter == next_char:
+                        subquestions.append(letter)
+                        next_char = chr(ord(letter) + 1)
+                    if len(k_split) == 3:
+                        numeral = k_split[2]
+                        subquestions.append(numeral)
+                    question_to_subquestions[q_num].append(".".join(k_split[1:]))
+
+            target_markscheme_fpath = os.path.join(
+                pdf_dir,
+                subdir,
+                "markscheme/parsed.json",
+            )
+            markscheme_journal_fpath = os.path.join(
+                pdf_dir,
+                subdir,
+                "markscheme/journal.jsonl",
+            )
+            if not os.path.exists(target_markscheme_fpath) or is_incomplete(
+                markscheme_journal_fpath,
+            ):
+                parse_markscheme(int(subdir), question_to_subquestions, subquestions)
+
+        stages.add("paper", _parse_paper)
+        stages.add("markscheme", _parse_markscheme, after=["question_to_pages"])
+        stages.run()
 
     unify.map(_parse, subdirs)
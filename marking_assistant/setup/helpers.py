@@ -1,20 +1,55 @@
 import base64
 import json
 import os
+import queue
+import re
+from contextlib import contextmanager
 from typing import Callable, List
 
 import cv2
+import unify
 from pydantic import create_model
 
 VALID_NUMERALS = ("i", "ii", "iii", "iv", "v", "vi")
 
 
+class ClientPool:
+    """
+    Bounded pool of stateless clients for one endpoint. Each concurrent worker
+    checks out a client of its own for as long as it needs it, so that setting the
+    system message never races with another worker, and the clients (and their
+    connections) are reused across workers rather than created for every call.
+    """
+
+    def __init__(self, endpoint, size=8, **kwargs):
+        self._clients = queue.Queue()
+        for _ in range(size):
+            self._clients.put(unify.Unify(endpoint, **kwargs))
+
+    @contextmanager
+    def client(self):
+        client = self._clients.get()
+        try:
+            yield client
+        finally:
+            self._clients.put(client)
+
+
 def build_response_format(question_num, sub_questions, dtype=str):
     response_keys = sub_questions if sub_questions else [str(question_num)]
     response_fields = dict(zip(response_keys, [(dtype, ...)] * len(response_keys)))
     return create_model("Response", **response_fields)
 
 
+def build_fused_response_format(question_num, sub_questions):
+    return create_model(
+        "FusedResponse",
+        question=(str, ...),
+        components=(build_response_format(question_num, sub_questions), ...),
+        text_only=(bool, ...),
+    )
+
+
 def is_invalid_question_order(detected_qs, valid_num, valid_char):
     valid_numeral = 0
     for i, item in enumerate(detected_qs):
@@ -87,6 +122,25 @@ def prune_invalid_leading_alphanumeric_questions(detected_qs):
     return list(reversed(ret))
 
 
+def guess_question_states(texts):
+    """
+    Cheaply guesses the (latest_num, latest_char) state each page starts from, by
+    scanning for lines which begin with the next question number and/or the next
+    `(letter)`. Used to speculatively detect questions on all pages at once.
+    """
+    states = list()
+    num, char = 0, "`"
+    for text in texts:
+        states.append((num, char))
+        for line in text.splitlines():
+            match = re.match(r"\s*(\d{1,2})?\s*(?:\(([a-z])\))?", line)
+            if match.group(1) == str(num + 1):
+                num, char = num + 1, "`"
+            if match.group(2) == chr(ord(char) + 1):
+                char = match.group(2)
+    return states
+
+
 def parse_key(k: str):
     """
     Splits the string on the first dot.
@@ -99,8 +153,19 @@ def parse_key(k: str):
     return num, suffix
 
 
-def encode_image(image_path):
-    _, buffer = cv2.imencode(".jpg", image_path)
+def encode_image(image_path, max_dim=None, quality=None, grayscale=False):
+    if grayscale:
+        image_path = cv2.cvtColor(image_path, cv2.COLOR_RGB2GRAY)
+    height, width = image_path.shape[0:2]
+    if max_dim is not None and max(height, width) > max_dim:
+        scale = max_dim / max(height, width)
+        image_path = cv2.resize(
+            image_path,
+            (round(width * scale), round(height * scale)),
+            interpolation=cv2.INTER_AREA,
+        )
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if quality is not None else []
+    _, buffer = cv2.imencode(".jpg", image_path, params)
     return base64.b64encode(buffer).decode("utf-8")
 
 
@@ -113,7 +178,7 @@ def load_questions_and_answers():
         subject = subject_dir.replace("_", " ")
         subject_dir_abs = os.path.join(pdfs_dir, subject_dir)
         for paper_dir in os.listdir(subject_dir_abs):
-            if paper_dir.endswith(".pdf"):
+            if not os.path.isdir(os.path.join(subject_dir_abs, paper_dir)):
                 continue
             paper_id = paper_dir.replace("_", " ")
             paper_dir_abs = os.path.join(subject_dir_abs, paper_dir)
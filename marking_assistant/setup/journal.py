@@ -0,0 +1,93 @@
+import atexit
+import json
+import os
+import queue
+import threading
+
+
+class Journal:
+    """
+    Append-only JSONL checkpoint of the finished units of work while parsing a pdf,
+    such as the questions detected on a page or a fully parsed question. Each line
+    is a `{"kind", "key", "value"}` record, and later records replace earlier ones.
+
+    If `sha256` is passed and differs from the hash the journal was written for,
+    the journal is discarded, since its results belong to a different pdf.
+
+    Records are pushed onto a queue and appended by a single writer thread, so
+    workers never wait on each other or on the file. A journal which is not closed
+    explicitly is closed at interpreter exit, so queued records are never lost.
+    """
+
+    def __init__(self, fpath, sha256=None):
+        self._fpath = fpath
+        self._records = dict()
+        partial = False
+        if os.path.exists(fpath):
+            with open(fpath) as file:
+                for line in file:
+                    partial = not line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line is partial if the previous run was killed
+                        # mid-write, and that unit of work is simply redone
+                        continue
+                    self._records[(record["kind"], record["key"])] = record["value"]
+        stale = sha256 is not None and self.get("meta", "sha256") != sha256
+        self._file = open(fpath, "w+" if stale else "a")
+        if partial and not stale:
+            self._file.write("\n")
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+        if stale:
+            self._records = dict()
+            self.record("meta", "sha256", sha256)
+
+    def _write(self):
+        while True:
+            line = self._queue.get()
+            if line is None:
+                break
+            self._file.write(line)
+            # flush whatever is queued together, rather than once per record
+            if self._queue.empty():
+                self._file.flush()
+
+    def __contains__(self, kind_n_key):
+        kind, key = kind_n_key
+        return (kind, str(key)) in self._records
+
+    def get(self, kind, key, default=None):
+        return self._records.get((kind, str(key)), default)
+
+    def record(self, kind, key, value):
+        self._records[(kind, str(key))] = value
+        line = json.dumps({"kind": kind, "key": str(key), "value": value})
+        self._queue.put(line + "\n")
+
+    @property
+    def complete(self):
+        return ("meta", "complete") in self
+
+    def mark_complete(self):
+        self.record("meta", "complete", True)
+
+    def close(self):
+        if self._file.closed:
+            return
+        atexit.unregister(self.close)
+        self._queue.put(None)
+        self._writer.join()
+        self._file.close()
+
+
+def is_incomplete(fpath):
+    """Whether a journal exists at `fpath` for a run which did not finish."""
+    if not os.path.exists(fpath):
+        return False
+    journal = Journal(fpath)
+    journal.close()
+    return not journal.complete
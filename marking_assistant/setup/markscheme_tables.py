@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import re
+
+from helpers import update_str_in_table
+from pages import PageLayouts
+
+# assessment objectives, e.g. "2 AO1.3a", listed under the marks of each row
+ASSESSMENT_OBJECTIVE = re.compile(r"\d+\s*AO[123]\.\w+")
+# symbol font characters which pdfplumber leaves in the unicode private use area
+SYMBOLS = {"\uf0b4": "×"}
+
+
+def _columns(header):
+    """
+    The indices of the question, answer, marks and guidance columns of a mark scheme
+    table, from its header row, or None if the row is not such a header.
+    """
+    cells = [cell.lower() for cell in header]
+    if cells[0] != "question" or "answer" not in cells or "marks" not in cells:
+        return None
+    answer, marks = cells.index("answer"), cells.index("marks")
+    return dict(
+        question=list(range(0, answer)),
+        answer=answer,
+        marks=marks,
+        guidance=list(range(marks + 1, len(cells))),
+        width=len(cells),
+    )
+
+
+def markscheme_rows(layouts, pages):
+    """
+    Reads the rows of the mark scheme tables on `pages` (numbered from 1), keyed by
+    question number and then by sub-question (e.g. "a.i"), or by the question number
+    itself for questions without sub-questions.
+
+    A table without a header row, of the same width as the last header, continues
+    its columns. A row without a question, part or marks continues the row before
+    it, which may be at the bottom of the previous page.
+    """
+    rows = dict()
+    columns = None
+    row = None
+    num, char, numeral = None, "", ""
+    for pg in pages:
+        for table in layouts.tables(pg - 1):
+            table = update_str_in_table(table, lambda x: x.strip())
+            header = _columns(table[0])
+            if header is not None:
+                columns, table = header, table[1:]
+            elif columns is None or len(table[0]) != columns["width"]:
+                continue
+            for cells in table:
+                parts = [cells[i] for i in columns["question"]]
+                cell = dict(
+                    answer=cells[columns["answer"]],
+                    marks=cells[columns["marks"]],
+                    guidance="\n".join(
+                        cells[i] for i in columns["guidance"] if cells[i]
+                    ),
+                )
+                if not any(parts) and not cell["marks"] and row is not None:
+                    for k, v in cell.items():
+                        row[k] = "\n".join(text for text in (row[k], v) if text)
+                    continue
+                if parts[0]:
+                    num, char, numeral = parts[0], "", ""
+                if len(parts) > 1 and parts[1]:
+                    char, numeral = parts[1].strip("()"), ""
+                if len(parts) > 2 and parts[2]:
+                    numeral = parts[2].strip("()")
+                if num is None or not num.isdigit():
+                    continue
+                key = ".".join(p for p in (char, numeral) if p) or num
+                question_rows = rows.setdefault(int(num), dict())
+                # a repeated part cannot be told apart from a misread one
+                row = question_rows[key] = None if key in question_rows else cell
+    return rows
+
+
+def _readable(text):
+    """
+    Whether the text of a cell survived extraction. Symbols without a unicode
+    mapping, stacked fractions (split over three lines) and figures which the text
+    refers to can only be read from the page image.
+    """
+    if re.search(r"[\ue000-\uf8ff]", text):
+        return False
+    if text.endswith(("e.g.", ":")):
+        return False
+    lines = text.split("\n")
+    return len(lines) == 1 or not any(re.fullmatch(r"\d{1,3}", ln) for ln in lines)
+
+
+def parse_markscheme_rows(question_rows, question_num, sub_questions):
+    """
+    The markscheme components and mark breakdown of a question from its table rows,
+    in the same form as the LLM parsers return them, or None if the rows do not
+    fully describe the question.
+    """
+    keys = sub_questions if sub_questions else [str(question_num)]
+    if sorted(question_rows) != sorted(keys):
+        return None
+    qna = dict()
+    mark_breakdown = dict()
+    for key in keys:
+        row = question_rows[key]
+        if row is None:
+            return None
+        marks = ASSESSMENT_OBJECTIVE.sub("", row["marks"]).strip()
+        answer, guidance = [
+            re.sub("|".join(SYMBOLS), lambda m: SYMBOLS[m.group()], row[k])
+            for k in ("answer", "guidance")
+        ]
+        if not marks.isdigit() or not answer:
+            return None
+        if not _readable(answer) or not _readable(guidance):
+            return None
+        qna[key] = f"Answer: {answer}\nMarks: {marks}"
+        if guidance:
+            qna[key] += f"\nMarking guidelines: {guidance}"
+        mark_breakdown[key] = int(marks)
+    total = sum(mark_breakdown.values())
+    if not sub_questions:
+        return qna, {"total": total}
+    return qna, {**mark_breakdown, "total": total}
+
+
+def benchmark(root):
+    """
+    Compares the mark breakdowns read from the tables against every
+    `markscheme/parsed.json` under `root`.
+    """
+    counts = dict(correct=0, wrong=0, fallback=0)
+    for dirpath, _, fnames in os.walk(root):
+        if not dirpath.endswith("markscheme") or "parsed.json" not in fnames:
+            continue
+        with open(os.path.join(dirpath, "question_to_pages.json")) as file:
+            question_to_pages = json.load(file)
+        with open(os.path.join(dirpath, "parsed.json")) as file:
+            parsed = json.load(file)
+        layouts = PageLayouts(dirpath + ".pdf")
+        pages = sorted({pg for v in question_to_pages.values() for pg in v})
+        rows = markscheme_rows(layouts, pages)
+        for question_num, question in parsed.items():
+            sub_questions = [
+                ".".join(k.split(".")[1:])
+                for k in question_to_pages
+                if k.startswith(question_num + ".")
+            ]
+            extracted = parse_markscheme_rows(
+                rows.get(int(question_num), dict()),
+                int(question_num),
+                sub_questions,
+            )
+            if extracted is None:
+                counts["fallback"] += 1
+            elif extracted[1] == question["mark-breakdown"]:
+                counts["correct"] += 1
+            else:
+                counts["wrong"] += 1
+                print(
+                    f"{dirpath} question {question_num}: {extracted[1]}, "
+                    f"saved {question['mark-breakdown']}",
+                )
+        layouts.close()
+    decided = counts["correct"] + counts["wrong"]
+    print(
+        f"{decided} questions read from the tables, {counts['fallback']} sent to "
+        f"the LLM\n"
+        f"mark breakdown agreement {counts['correct'] / max(decided, 1):.2f}\n"
+        f"{counts}",
+    )
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--root",
+        default=os.path.join(os.path.dirname(__file__), "..", "data", "parsed"),
+        type=str,
+    )
+    args = parser.parse_args()
+    benchmark(args.root)
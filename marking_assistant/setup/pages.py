@@ -0,0 +1,298 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pdfplumber
+from helpers import encode_image
+from pdf2image import convert_from_path
+from pypdf import PdfReader
+
+
+def pil_to_array(img):
+    # PIL exposes its pixel buffer via the array interface, so this is a single
+    # contiguous uint8 copy rather than a python sequence of per-pixel tuples
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return np.asarray(img)
+
+
+def load_ppm(fpath):
+    """
+    Memory-maps a binary (P6) PPM file, as written by poppler, as an
+    (height, width, 3) uint8 array, without reading the pixels into memory.
+    """
+    with open(fpath, "rb") as file:
+        header = file.read(64)
+    tokens = list()
+    pos = 0
+    while len(tokens) < 4:
+        while header[pos : pos + 1].isspace():
+            pos += 1
+        start = pos
+        while not header[pos : pos + 1].isspace():
+            pos += 1
+        tokens.append(header[start:pos])
+    assert tokens[0] == b"P6", f"Expected a binary PPM file, but found {tokens[0]}"
+    width, height = int(tokens[1]), int(tokens[2])
+    return np.memmap(
+        fpath,
+        dtype=np.uint8,
+        mode="r",
+        offset=pos + 1,
+        shape=(height, width, 3),
+    )
+
+
+def file_sha256(fpath):
+    with open(fpath, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class PageImages:
+    """
+    Page images of a pdf, indexed from 0 like a list, which are only rendered when
+    first accessed. Each rendered page is persisted as `imgs/page{n}.png`, and held in
+    an LRU cache which is bounded by `max_bytes`.
+
+    `imgs/manifest.json` records the content hash of the pdf and the dpi the pngs
+    were rendered with, so that pngs from a previous run of the same pdf are read
+    back directly, without calling poppler at all.
+
+    The base64 jpeg payloads sent to vision calls are also cached, so each page is
+    only encoded once for each resolution, quality and color mode while it is held.
+    The payloads count towards `max_bytes`, and are evicted with their page.
+    """
+
+    def __init__(
+        self,
+        pdf_path,
+        img_dir,
+        dpi=200,
+        max_bytes=512 * 1024**2,
+        memmap_dir=None,
+    ):
+        self._pdf_path = pdf_path
+        self._img_dir = img_dir
+        self._dpi = dpi
+        self._max_bytes = max_bytes
+        self._memmap_dir = memmap_dir
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        # the payloads of each page held in the cache, by encoding parameters
+        self._payloads = dict()
+        os.makedirs(img_dir, exist_ok=True)
+        self._manifest = self._load_manifest(file_sha256(pdf_path))
+        self._num_pages = self._manifest["num_pages"]
+        self._page_locks = [threading.Lock() for _ in range(self._num_pages)]
+
+    def _load_manifest(self, sha256):
+        fpath = os.path.join(self._img_dir, "manifest.json")
+        if os.path.exists(fpath):
+            with open(fpath) as file:
+                manifest = json.load(file)
+            if manifest["sha256"] == sha256 and manifest["dpi"] == self._dpi:
+                manifest["pages"] = set(manifest["pages"])
+                return manifest
+        return dict(
+            sha256=sha256,
+            dpi=self._dpi,
+            num_pages=len(PdfReader(self._pdf_path).pages),
+            pages=set(),
+        )
+
+    def _save_manifest(self):
+        with open(os.path.join(self._img_dir, "manifest.json"), "w+") as file:
+            file.write(
+                json.dumps(
+                    {**self._manifest, "pages": sorted(self._manifest["pages"])},
+                    indent=4,
+                ),
+            )
+
+    def __len__(self):
+        return self._num_pages
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def _fpath(self, idx):
+        return os.path.join(self._img_dir, f"page{idx + 1}.png")
+
+    def _render(self, idx):
+        if idx in self._manifest["pages"] and os.path.exists(self._fpath(idx)):
+            return cv2.imread(self._fpath(idx))
+        page = dict(first_page=idx + 1, last_page=idx + 1, dpi=self._dpi)
+        if self._memmap_dir is None:
+            img = pil_to_array(convert_from_path(self._pdf_path, **page)[0])
+        else:
+            os.makedirs(self._memmap_dir, exist_ok=True)
+            fpath = convert_from_path(
+                self._pdf_path,
+                output_folder=self._memmap_dir,
+                fmt="ppm",
+                paths_only=True,
+                **page,
+            )[0]
+            img = load_ppm(fpath)
+            # the mapping keeps the unlinked file readable until the array is
+            # evicted and collected, so no ppm is left behind in memmap_dir
+            os.remove(fpath)
+        cv2.imwrite(self._fpath(idx), img)
+        with self._lock:
+            self._manifest["pages"].add(idx)
+            self._save_manifest()
+        return img
+
+    def __getitem__(self, idx):
+        if idx < 0 or idx >= self._num_pages:
+            raise IndexError(f"Page index {idx} out of range for {self._pdf_path}")
+        with self._page_locks[idx]:
+            with self._lock:
+                if idx in self._cache:
+                    self._cache.move_to_end(idx)
+                    return self._cache[idx]
+            img = self._render(idx)
+            with self._lock:
+                self._cache[idx] = img
+                self._nbytes += img.nbytes
+                self._evict()
+            return img
+
+    def _evict(self):
+        # called with the lock held, and always keeps the most recently used page
+        while self._nbytes > self._max_bytes and len(self._cache) > 1:
+            evicted_idx, evicted = self._cache.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+            for payload in self._payloads.pop(evicted_idx, dict()).values():
+                self._nbytes -= len(payload)
+
+    def encoded(self, idx, max_dim=None, quality=None, grayscale=False):
+        key = (max_dim, quality, grayscale)
+        with self._lock:
+            if key in self._payloads.get(idx, dict()):
+                self._cache.move_to_end(idx)
+                return self._payloads[idx][key]
+        payload = encode_image(
+            self[idx],
+            max_dim=max_dim,
+            quality=quality,
+            grayscale=grayscale,
+        )
+        with self._lock:
+            # the page may have been evicted while it was being encoded
+            if idx not in self._cache:
+                return payload
+            payloads = self._payloads.setdefault(idx, dict())
+            if key not in payloads:
+                payloads[key] = payload
+                self._nbytes += len(payload)
+                self._evict()
+            return payloads[key]
+
+
+class PageLayouts:
+    """
+    Text, words, tables and drawn graphics of the pages of a pdf, indexed from 0 like
+    `PageImages`. pdfplumber's layout analysis runs once per page, the first time
+    anything on the page is asked for, and the page is then closed to free its
+    parsed objects.
+
+    With `prefetch=True` every page is extracted up front by a background thread
+    pool. Each thread opens its own pdfplumber handle, since pages of one handle
+    share a single parser.
+    """
+
+    def __init__(self, pdf_path, prefetch=False, max_workers=4):
+        self._pdf_path = pdf_path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._handles = list()
+        self._layouts = dict()
+        self._num_pages = len(self._pdf().pages)
+        self._page_locks = [threading.Lock() for _ in range(self._num_pages)]
+        self._executor = None
+        if prefetch:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+            [self._executor.submit(self._layout, i) for i in range(self._num_pages)]
+
+    def _pdf(self):
+        pdf = getattr(self._local, "pdf", None)
+        if pdf is None:
+            pdf = self._local.pdf = pdfplumber.open(self._pdf_path)
+            with self._lock:
+                self._handles.append(pdf)
+        return pdf
+
+    def __len__(self):
+        return self._num_pages
+
+    def _extract(self, idx):
+        page = self._pdf().pages[idx]
+        tables = page.find_tables()
+        extracted = [table.extract() for table in tables]
+        # the same choice of table as `page.extract_table()`, without finding twice
+        largest = min(
+            range(len(tables)),
+            key=lambda i: (-len(tables[i].cells), tables[i].bbox[1], tables[i].bbox[0]),
+            default=None,
+        )
+        layout = dict(
+            text=page.extract_text(),
+            # the font of each word is what sets question markers apart from text
+            words=page.extract_words(extra_attrs=["fontname", "size"]),
+            tables=extracted,
+            table=extracted[largest] if largest is not None else None,
+            size=(page.width, page.height),
+            # drawn objects which could make up a diagram, rather than text, rules
+            # and boxes
+            graphics=dict(
+                images=len(page.images),
+                curves=len(page.curves),
+                diagonal_lines=sum(
+                    abs(line["x1"] - line["x0"]) > 1
+                    and abs(line["bottom"] - line["top"]) > 1
+                    for line in page.lines
+                ),
+            ),
+        )
+        page.close()
+        return layout
+
+    def _layout(self, idx):
+        if idx < 0 or idx >= self._num_pages:
+            raise IndexError(f"Page index {idx} out of range for {self._pdf_path}")
+        with self._page_locks[idx]:
+            if idx not in self._layouts:
+                self._layouts[idx] = self._extract(idx)
+            return self._layouts[idx]
+
+    def text(self, idx):
+        return self._layout(idx)["text"]
+
+    def words(self, idx):
+        return self._layout(idx)["words"]
+
+    def tables(self, idx):
+        return self._layout(idx)["tables"]
+
+    def table(self, idx):
+        return self._layout(idx)["table"]
+
+    def size(self, idx):
+        return self._layout(idx)["size"]
+
+    def graphics(self, idx):
+        return self._layout(idx)["graphics"]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+        with self._lock:
+            [pdf.close() for pdf in self._handles]
+            self._handles.clear()
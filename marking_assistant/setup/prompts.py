@@ -221,6 +221,56 @@ yes
 no
 """
 
+FUSED_QUESTION_PARSER = """
+Your task is to extract the full contents of question {question_number} from the
+following text and images, to parse it into its sub-components, and to determine
+whether it can be answered in a text-only manner. You should *not* extract any parts
+of the preceding question {preceding} or subsequent question {subsequent}.
+
+The question was parsed from a PDF, and the formatting might be strange or wrong as a
+result of this conversion to pure text. More importantly, mathematical symbols
+such as √w, x², y₄, ⁴√z etc. are very often missed by the parsing logic. Sometimes,
+entire equations are embedded in the PDF as images, and will not be shown in the text.
+Image(s) of the relevant page(s) have therefore *also* been provided.
+
+In the `question` field, please extract **all** important information for question
+{question_number} **including any symbols and/or equations missing in the text**,
+by inferring these from the provided image(s). If the formatting could be improved
+to make the question more readable in text-only format, please make any formatting
+improvements as you see fit. Do not provide any explanations or commentary.
+
+In the `components` field, please parse the question into its known sub-components,
+whilst disregarding general explanatory text. For example, if a question has the
+following structure:
+
+```
+2. This is some general information about the question, explaining the problem.
+
+a) This is a question.
+
+Here is some more information.
+
+b) i) This is another question.
+
+   ii) This is yet another question.
+```
+
+Then the components should be:
+
+```
+{
+    "a": "This is a question."
+    "b.i": "This is another question."
+    "b.ii": "This is yet another question."
+}
+```
+
+In the `text_only` field, please respond with true if the question can be answered
+using only a keyboard, and false if it requires drawing on the page in a non-textual
+manner. The answer can still be text-only even if there is a diagram as part of the
+question, presuming that the recipient *does* have access to any necessary diagrams.
+"""
+
 MARK_BREAKDOWN_DETECTION = """
 Your task is to determine the total number of marks available for each component of
 this question. The total number of marks are shown under the marks heading (disregard
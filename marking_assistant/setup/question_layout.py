@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import re
+from collections import Counter, defaultdict
+
+from helpers import VALID_NUMERALS, is_invalid_question_order
+from pages import PageLayouts
+
+# markers further than this (in pdf points) from their column are not markers
+COLUMN_TOLERANCE = 3
+# markers further than this (in pdf points) from the body font size are not markers
+SIZE_TOLERANCE = 1.5
+# words closer than this vertically (in pdf points) are on the same line
+LINE_TOLERANCE = 2
+
+NUMBER = re.compile(r"\d{1,2}")
+BRACKETED = re.compile(r"\(([a-z]{1,4})\)")
+
+
+def _mode(values):
+    counts = Counter(round(v) for v in values)
+    return counts.most_common(1)[0][0] if counts else None
+
+
+def _in_lines(words):
+    """Sorts words into reading order, treating words at about the same height as
+    one line, even if their tops differ by a fraction of a point."""
+    ordered = list()
+    line, line_top = -1, None
+    for word in sorted(words, key=lambda w: w["top"]):
+        if line_top is None or word["top"] - line_top > LINE_TOLERANCE:
+            line, line_top = line + 1, word["top"]
+        ordered.append((line, word["x0"], word))
+    return [word for _, _, word in sorted(ordered, key=lambda item: item[:2])]
+
+
+class QuestionLayout:
+    """
+    Detects the question numbers, `(a)` letters and `(i)` numerals on each page of a
+    question paper from the layout of its words alone, in the same form as the LLM
+    question detector, i.e. `["4", "a", "i", "ii", "b"]`.
+
+    Markers are the bold words in the body font size which start at one of three
+    left-margin columns: the question numbers, the letters and the numerals. Each
+    column is the most common x-position of such words across the whole paper.
+
+    `detect` returns None for pages it cannot answer confidently, including pages on
+    which it finds no marker at all (such as the cover), which should be sent to the
+    LLM instead.
+    """
+
+    def __init__(self, layouts):
+        self._layouts = layouts
+        words = [w for i in range(len(layouts)) for w in layouts.words(i)]
+        self._body_size = _mode(w["size"] for w in words)
+        candidates = [w for i in range(len(layouts)) for w in self._candidates(i)]
+        self._number_x = _mode(
+            w["x0"] for w in candidates if NUMBER.fullmatch(w["text"])
+        )
+        bracketed = [
+            (w["x0"], BRACKETED.fullmatch(w["text"]).group(1))
+            for w in candidates
+            if BRACKETED.fullmatch(w["text"])
+        ]
+        self._letter_x = _mode(x for x, v in bracketed if v not in VALID_NUMERALS)
+        self._numeral_x = _mode(
+            x
+            for x, v in bracketed
+            if v in VALID_NUMERALS and not self._at(x, self._letter_x)
+        )
+
+    def _candidates(self, idx):
+        width, _ = self._layouts.size(idx)
+        return [
+            w
+            for w in self._layouts.words(idx)
+            if "bold" in w["fontname"].lower()
+            and abs(w["size"] - self._body_size) <= SIZE_TOLERANCE
+            and w["x0"] < width / 3
+            and (NUMBER.fullmatch(w["text"]) or BRACKETED.fullmatch(w["text"]))
+        ]
+
+    @staticmethod
+    def _at(x, column):
+        return column is not None and abs(x - column) <= COLUMN_TOLERANCE
+
+    def detect(self, idx, latest_num, latest_char):
+        """
+        The markers on page `idx` (indexed from 0), given the question and letter
+        the previous page ended on, or None if the page is ambiguous or has no
+        markers.
+        """
+        if self._number_x is None:
+            return None
+        detected_qs = list()
+        for word in _in_lines(self._layouts.words(idx)):
+            at_number = self._at(word["x0"], self._number_x)
+            at_letter = self._at(word["x0"], self._letter_x)
+            at_numeral = self._at(word["x0"], self._numeral_x)
+            number = at_number and NUMBER.fullmatch(word["text"])
+            bracketed = (at_letter or at_numeral) and BRACKETED.fullmatch(word["text"])
+            if not (number or bracketed):
+                continue
+            if abs(word["size"] - self._body_size) > SIZE_TOLERANCE:
+                continue
+            # a marker-like word in a marker column, but not set like one
+            if "bold" not in word["fontname"].lower():
+                return None
+            if number:
+                detected_qs.append(str(int(word["text"])))
+            elif at_numeral and bracketed.group(1) in VALID_NUMERALS:
+                detected_qs.append(bracketed.group(1))
+            elif len(bracketed.group(1)) == 1:
+                detected_qs.append(bracketed.group(1))
+            else:
+                return None
+        if not detected_qs:
+            return None
+        if is_invalid_question_order(
+            detected_qs,
+            str(latest_num + 1),
+            chr(ord(latest_char) + 1),
+        ):
+            return None
+        return detected_qs
+
+
+def _expected_detections(question_to_pages):
+    """
+    The markers each page should be detected with, recovered from a saved
+    `question_to_pages.json`, where each part of a key is detected on the first
+    page of the first key it appears in.
+    """
+    expected = defaultdict(list)
+    seen = set()
+    for key, pages in question_to_pages.items():
+        parts = key.split(".")
+        for i in range(len(parts)):
+            if tuple(parts[: i + 1]) not in seen:
+                seen.add(tuple(parts[: i + 1]))
+                expected[min(pages)].append(parts[i])
+    return expected
+
+
+def benchmark(root):
+    """
+    Compares the detector against every `paper/question_to_pages.json` under
+    `root`, replaying the pages in order from the saved (rather than the detected)
+    state, as `parse_into_pages` would after any fallback to the LLM.
+    """
+    counts = dict(correct=0, wrong=0, ambiguous=0)
+    for dirpath, _, fnames in os.walk(root):
+        if not dirpath.endswith("paper") or "question_to_pages.json" not in fnames:
+            continue
+        with open(os.path.join(dirpath, "question_to_pages.json")) as file:
+            expected = _expected_detections(json.load(file))
+        layouts = PageLayouts(dirpath + ".pdf")
+        detector = QuestionLayout(layouts)
+        latest_num, latest_char = 0, "`"
+        for idx in range(len(layouts)):
+            detected_qs = detector.detect(idx, latest_num, latest_char)
+            expected_qs = expected.get(idx + 1, list())
+            if detected_qs is None:
+                counts["ambiguous"] += 1
+            elif detected_qs == expected_qs:
+                counts["correct"] += 1
+            else:
+                counts["wrong"] += 1
+                print(f"{dirpath} page {idx + 1}: {detected_qs}, saved {expected_qs}")
+            for item in expected_qs:
+                if item.isdigit():
+                    latest_num, latest_char = int(item), "`"
+                elif item not in VALID_NUMERALS:
+                    latest_char = item
+        layouts.close()
+    decided = counts["correct"] + counts["wrong"]
+    print(
+        f"{decided} pages detected from the layout, {counts['ambiguous']} sent to "
+        f"the LLM\n"
+        f"agreement with the saved mappings {counts['correct'] / max(decided, 1):.2f}"
+        f"\n{counts}",
+    )
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--root",
+        default=os.path.join(os.path.dirname(__file__), "..", "data", "parsed"),
+        type=str,
+    )
+    args = parser.parse_args()
+    benchmark(args.root)
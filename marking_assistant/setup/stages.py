@@ -0,0 +1,48 @@
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Stages:
+    """
+    A small DAG of pipeline stages, each of which runs in its own thread as soon as
+    all of the events it depends on are set. A stage sets the event of its own name
+    when it returns, and can set intermediate events mid-way through, via the `emit`
+    callback it is called with, so that downstream stages need not wait for all of
+    its work.
+
+    If a stage raises, every event is set so that no stage waits forever, the
+    stages which had not started yet are skipped, and `run` re-raises the error.
+    """
+
+    def __init__(self):
+        self._stages = dict()
+        self._events = defaultdict(threading.Event)
+        self._failed = threading.Event()
+
+    def add(self, name, fn, after=()):
+        assert name not in self._stages, f"Stage {name} is already defined"
+        self._stages[name] = (fn, tuple(after))
+
+    def emit(self, event):
+        self._events[event].set()
+
+    def _run_stage(self, name):
+        fn, after = self._stages[name]
+        [self._events[event].wait() for event in after]
+        if self._failed.is_set():
+            return
+        try:
+            fn(self.emit)
+        except BaseException:
+            self._failed.set()
+            [event.set() for event in list(self._events.values())]
+            raise
+        self.emit(name)
+
+    def run(self):
+        # create every awaited event up front, so a failure can release all of them
+        [self._events[event] for _, after in self._stages.values() for event in after]
+        with ThreadPoolExecutor(max_workers=len(self._stages)) as executor:
+            futures = [executor.submit(self._run_stage, name) for name in self._stages]
+            [future.result() for future in futures]